@@ -1,60 +1,75 @@
-from email.policy import default
+""" Application factory.
+
+`flask` commands find create_app() and only get the configuration, the database and the commands: the web part
+(login, blueprints, metrics) is initialised by init_web() on the first request, or right away for the WEB_COMMANDS
+which need the routes. Servers should serve app.wsgi:app, which is initialised at import so that it can be
+preloaded before forking workers.
+"""
+import threading
 
-from flask import Flask
 import click
+from flask import Flask
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///data.db"  # Use SQLite for simplicity
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SECRET_KEY"] = "RandomKey"
-
-from .bp_main import bp_main
-from .bp_auth import bp_auth, login_manager
-from .db import db, Doc, Line, import_jsonl_stream, User
-from .forms import UploadForm
-
-db.init_app(app)
-login_manager.init_app(app)
-app.register_blueprint(bp_main)
-app.register_blueprint(bp_auth)
-
-@app.cli.group("db")
-def db_group():
-    return
-
-@db_group.command("create")
-@click.option("--admin/--no-admin", is_flag=True, default=True)
-@click.option("--admin-name", type=str, default="admin")
-@click.option("--admin-password", type=str, default="qwerty")
-def db_create(admin, admin_name, admin_password):
-    with app.app_context():
-        db.create_all()
-        click.echo("DB Created")
-        if admin:
-            admin = User(username=admin_name, is_admin=True, is_approved=True)
-            admin.set_password(admin_password)
-            db.session.add(admin)
-            db.session.commit()
-            click.echo("Admin created")
-
-
-@db_group.command("reset")
-def db_create():
-    with app.app_context():
-        db.drop_all()
-        db.create_all()
-    click.echo("DB Recreated")
+from .config import load_config, register_sqlite_pragmas, dispose_after_fork
+from .db import db
+from .cli import init_cli
+
+WEB_COMMANDS = ("routes", "shell")  # Flask commands reading the routes, or where url_for() may be used
+
+
+class LazyWeb:
+    """ WSGI middleware running init_web() before the first request it serves
+    """
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.lock = threading.Lock()
+        self.ready = False
 
-@db_group.command("drop")
-def db_create():
+    def __call__(self, environ, start_response):
+        if not self.ready:
+            with self.lock:
+                init_web(self.app)
+                self.ready = True
+        return self.wsgi_app(environ, start_response)
+
+
+def create_app(config=None, web=False):
+    """ Build the application, `config` overriding the configuration (see app/config.py). With `web`, the web
+    part is initialised right away instead of on the first request.
+
+    Requests go through the app and initialise it, but a request context built by hand, e.g. with
+    app.test_request_context(), does not: url_for() only knows the routes once init_web(app) ran, pass `web`
+    to use it.
+    """
+    app = Flask(__name__)
+    load_config(app, config)
+
+    db.init_app(app)
     with app.app_context():
-        db.drop_all()
-    click.echo("DB Dropped")
+        register_sqlite_pragmas(app, db.engine)
+        dispose_after_fork(db.engine)
+    init_cli(app)
+
+    app.wsgi_app = LazyWeb(app, app.wsgi_app)
+    command = click.get_current_context(silent=True)
+    if web or (command is not None and command.info_name in WEB_COMMANDS):
+        init_web(app)
+    return app
+
+
+def init_web(app):
+    """ Register the login manager, the blueprints and the metrics hooks, once
+    """
+    if "paramhtrs.web" in app.extensions:
+        return
+    from .bp_main import bp_main
+    from .bp_auth import bp_auth, login_manager
+    from .metrics import init_metrics
 
-@app.cli.command("import")
-@click.argument("jsonl")
-def import_(jsonl):
     with app.app_context():
-        with open(jsonl) as f:
-            for x, *_ in import_jsonl_stream(f):
-                print(x.strip())
\ No newline at end of file
+        init_metrics(app, db.engine)
+    login_manager.init_app(app)
+    app.register_blueprint(bp_main)
+    app.register_blueprint(bp_auth)
+    app.extensions["paramhtrs.web"] = True
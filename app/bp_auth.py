@@ -1,11 +1,62 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+import collections
+import threading
+import time
+
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_user, logout_user, current_user
+from sqlalchemy.orm import make_transient_to_detached
 from .db import User, db
 from flask_login import LoginManager, login_required
 
 
 login_manager = LoginManager()
 
+USER_CACHE_SIZE = 1024  # Users kept by the user loader cache of a process
+
+
+class UserCache:
+    """ Detached copies of the users loaded by `load_user`, by id, for USER_CACHE_TTL seconds. The least
+    recently used user goes first when the cache is full.
+
+    The cache is per process: the routes changing a user invalidate it here, other processes see the change
+    once the TTL expired.
+    """
+    def __init__(self, size=USER_CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, ttl):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            user, loaded_at = entry
+            if time.monotonic() - loaded_at > ttl:
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return user
+
+    def put(self, user):
+        copy = User(**{column.key: getattr(user, column.key) for column in User.__table__.columns})
+        make_transient_to_detached(copy)
+        with self.lock:
+            self.entries[user.id] = (copy, time.monotonic())
+            self.entries.move_to_end(user.id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(user_id, None)
+
+
+user_cache = UserCache()
+
 bp_auth = Blueprint('bp_auth', __name__)
 
 
@@ -67,6 +118,7 @@ def approve_user(user_id):
     user = User.query.get_or_404(user_id)
     user.is_approved = True
     db.session.commit()
+    user_cache.invalidate(user.id)
     flash(f"User {user.username} has been approved.", "success")
     return redirect(url_for("bp_main.home_route"))
 
@@ -81,6 +133,7 @@ def reject_user(user_id):
     user = User.query.get_or_404(user_id)
     db.session.delete(user)
     db.session.commit()
+    user_cache.invalidate(user_id)
     flash(f"User {user.username} has been rejected.", "success")
     return redirect(url_for("bp_main.home_route"))
 
@@ -105,6 +158,7 @@ def change_password():
         # Update the password
         current_user.set_password(new_password)
         db.session.commit()
+        user_cache.invalidate(current_user.id)
 
         flash("Your password has been updated successfully.", "success")
         return redirect(url_for("bp_main.home_route"))
@@ -128,6 +182,7 @@ def admin_panel():
             if user and user.is_approved:
                 user.set_password(new_password)  # Hash and update password
                 db.session.commit()
+                user_cache.invalidate(user.id)
                 flash(f"Password updated for {user.username}.", "success")
             else:
                 flash("User not found or not approved.", "danger")
@@ -145,4 +200,15 @@ def admin_panel():
 # User loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    ttl = current_app.config.get("USER_CACHE_TTL", 0)
+    if ttl <= 0:
+        return User.query.get(int(user_id))
+
+    cached = user_cache.get(int(user_id), ttl)
+    if cached is not None:
+        # Attach a copy to the session without querying, so that the user can still be changed and committed
+        return db.session.merge(cached, load=False)
+    user = User.query.get(int(user_id))
+    if user is not None:
+        user_cache.put(user)
+    return user
@@ -1,15 +1,32 @@
+import datetime
+import io
 import json
+import time
 
-from flask import Blueprint, render_template, request, jsonify, Response, stream_with_context
-from sqlalchemy import func, or_, case, and_
-import io
+from flask import (Blueprint, render_template, stream_template, request, jsonify, Response, stream_with_context,
+                   make_response, current_app, url_for, abort, session)
+from sqlalchemy import func, and_, select
+from sqlalchemy.orm import defer, load_only
 
-from .db import db, Doc, Line, import_jsonl_stream
+from .bulk import count_lines, set_lines_status, STATUSES
+from .db import (db, Doc, ImportJob, ImportStats, import_jsonl_stream, apply_line_updates, lines_page, touch_doc,
+                 iter_doc_exports, doc_export, doc_merged_rows, lookup_abbreviations, journal_cursor, changed_since,
+                 throughput, ROLLUP_PERIODS, EditConflict, lines_changed_since, record_doc_change)
 from .forms import UploadForm
-from flask_login import login_required
+from .jobs import enqueue_upload, request_cancel, job_json, fail_orphaned_jobs
+from .search import filter_documents, index_ready, search_lines
+from flask_login import login_required, current_user
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from wtforms import ValidationError
 
 bp_main = Blueprint("bp_main", __name__)
 
+LINES_UPDATE_MAX = 1000  # Line updates accepted by a single batched save, and lines served by page
+LINES_PAGE_SIZE = 100  # Lines fetched at once by the lines editor
+IMPORT_JOBS_LISTED = 10  # Recent import jobs shown on the import page
+IMPORT_STREAM_BUFFER = 64 * 1024  # Bytes read at once from a streamed import
+ABBREVIATIONS_MAX = 50  # Expansions returned by a lookup at most
+
 
 @bp_main.route("/")
 def home_route():
@@ -23,49 +40,33 @@ def documents_route():
     hide_query = request.args.get('hide', 0, type=int)
 
     if request.args.get("download"):
-        if request.args.get("incomplete"):
-            docs =  (
-                db.session.query(Doc)
-                .join(Line, Doc.id == Line.doc_id)
-                .group_by(Doc.id)
-                .having(func.sum(case((Line.status != "Pending", 1), else_=0)) >= 1)  # No unvalidated lines
-                .all()
-            )
-        else:
-            docs = (
-                db.session.query(Doc)
-                .join(Line, Doc.id == Line.doc_id)
-                .group_by(Doc.id)
-                .having(
-                    func.count(case((Line.status == "Pending", 1), else_=None)) == 0
-                )  # No pending lines
-                .all()
+        incomplete = bool(request.args.get("incomplete"))
+        since = request.args.get("since", None, type=int)
+        # Read before the export, edits made while it runs are part of the next incremental export
+        cursor = journal_cursor()
+        documents, revisions, last_id, last_modified = db.session.execute(
+            select(func.count(Doc.id), func.coalesce(func.sum(Doc.revision), 0), func.max(Doc.id),
+                   func.max(Doc.updated_at))
+        ).one()
+        return _conditional_response(
+            f"corpus-{documents}-{revisions}-{last_id}-{'incomplete' if incomplete else 'complete'}"
+            f"{'' if since is None else f'-since-{since}'}",
+            last_modified,
+            lambda: Response(
+                stream_with_context(_export_documents(incomplete=incomplete, since=since)),
+                mimetype="application/json",
+                headers={
+                    "Content-Disposition": "attachment",
+                    "filename": f"eAbbrevium.json",
+                    "X-Journal-Cursor": str(cursor)
+                }
             )
-        return Response(
-            json.dumps([document.json() for document in docs]),
-            mimetype="application/json",
-            headers={
-                "Content-Disposition": "attachment",
-                "filename": f"eAbbrevium.json"
-            }
         )
 
     # Apply the search filter if there's a query, and order by title
+    query = filter_documents(Doc.query, search_query)
     if hide_query == 1:
-        query = Doc.query.join(Doc.lines).filter(
-            and_(
-                or_(
-                    Doc.title.ilike(f'%{search_query}%'),
-                    Doc.human_readable.ilike(f"%{search_query}%")
-                ),
-                Line.status == "Pending"
-            )
-        ).distinct()
-    else:
-        query = Doc.query.filter(or_(
-            Doc.title.ilike(f'%{search_query}%'),
-            Doc.human_readable.ilike(f"%{search_query}%")
-        ))
+        query = query.filter(Doc.pending_count > 0)
 
     query = query.order_by(func.lower(Doc.human_readable), func.lower(Doc.title))
 
@@ -86,15 +87,138 @@ def documents_route():
     )
 
 
+def _doc_etag(document, view):
+    return f"doc-{document.id}-{document.revision}-{view}"
+
+
+def _conditional_response(etag, last_modified, build):
+    """ Answer conditional requests matching the ETag or Last-Modified with a 304 without calling
+    build(), otherwise tag the response build() returns
+    """
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0, tzinfo=datetime.UTC)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = bool(last_modified and request.if_modified_since
+                            and last_modified <= request.if_modified_since)
+
+    response = Response(status=304) if not_modified else make_response(build())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def _page_response(document, view, build):
+    """ Conditional response of an HTML page of a document. base.html shows the admin menu and consumes the
+    flashed messages: the ETag includes the user and their role, and pending messages always get a full page.
+    """
+    etag = _doc_etag(document, f"{view}-{current_user.get_id()}-{'admin' if current_user.is_admin else 'user'}")
+    if session.get("_flashes"):
+        response = make_response(build())
+        response.set_etag(etag)
+        return response
+    return _conditional_response(etag, document.updated_at, build)
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _line_update_error(update):
+    """ Why a line update cannot be applied, or None: it needs an integer `id` and, if any, an integer
+    `version`, a `status` of STATUSES, a boolean `merge` and a string `normalized`
+    """
+    if not isinstance(update, dict):
+        return "Line updates must be JSON objects"
+    if not _is_int(update.get("id")):
+        return "The line id must be an integer"
+    if update.get("version") is not None and not _is_int(update["version"]):
+        return "The line version must be an integer"
+    if "status" in update and update["status"] not in STATUSES:
+        return f"The status must be one of {', '.join(STATUSES)}"
+    if "merge" in update and not isinstance(update["merge"], bool):
+        return "merge must be a boolean"
+    if update.get("normalized") is not None and not isinstance(update["normalized"], str):
+        return "normalized must be a string"
+    return None
+
+
+def _export_documents(incomplete=False, since=None):
+    """ Stream the JSON array of downloadable documents from their cached exports, only the ones changed
+    after the journal cursor `since` if given
+    """
+    if incomplete:
+        downloadable = Doc.lines_count - Doc.pending_count >= 1  # At least one corrected line
+    else:
+        downloadable = and_(Doc.lines_count > 0, Doc.pending_count == 0)  # No pending lines
+    criteria = [downloadable] if since is None else [downloadable, changed_since(since)]
+
+    yield "["
+    separator = ""
+    for _, payload in iter_doc_exports(*criteria):
+        yield separator + payload
+        separator = ", "
+    yield "]"
+
+
+@bp_main.route("/search", methods=["GET"])
+@login_required
+def search_route():
+    search_query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+
+    if not search_query or not index_ready():
+        results = None
+    else:
+        results = search_lines(search_query, page=page)
+
+    if request.args.get("format") == "json":
+        if results is None:
+            return jsonify({"status": "error", "message": "No query or no search index"}), 400
+        return jsonify({
+            "page": results.page,
+            "pages": results.pages,
+            "total": results.total,
+            "results": [
+                {"id": line.id, "doc_id": line.doc_id, "document": line.doc.displayable_title,
+                 "canonical": line.canonical, "normalized": line.normalized, "status": line.status}
+                for line in results.items
+            ]
+        })
+
+    return render_template("search.html", results=results, search_query=search_query)
+
+
+@bp_main.route("/abbreviations", methods=["GET"])
+@login_required
+def abbreviations_route():
+    """ Most frequent expansions of the abbreviations starting with `q`, or equal to it with `exact=1`
+    """
+    search_query = request.args.get("q", "").strip()
+    exact = bool(request.args.get("exact", 0, type=int))
+    limit = min(max(request.args.get("limit", 10, type=int), 1), ABBREVIATIONS_MAX)
+    if not search_query:
+        return jsonify({"status": "error", "message": "No query"}), 400
+    return jsonify({"query": search_query, "exact": exact,
+                    "results": lookup_abbreviations(search_query, exact=exact, limit=limit)})
+
+
 @bp_main.route("/document/<int:doc_id>", methods=["GET", "POST"])
 @login_required
 def document_route(doc_id):
-    document = Doc.query.get_or_404(doc_id)
+    document = Doc.query.options(defer(Doc.text)).get_or_404(doc_id)
     if request.method == "GET":
-        return Response(json.dumps(document.json()), mimetype="application/json", headers={
-            "Content-Disposition": "attachment",
-            "filename": f"doc{doc_id}.json"
-        })
+        return _conditional_response(
+            _doc_etag(document, "json"),
+            document.updated_at,
+            lambda: Response(doc_export(document.id), mimetype="application/json", headers={
+                "Content-Disposition": "attachment",
+                "filename": f"doc{doc_id}.json"
+            })
+        )
     # Try to capture and debug the incoming data
     data = request.get_json()  # This will parse the incoming JSON body
     if not data:
@@ -104,8 +228,13 @@ def document_route(doc_id):
     new_name = data.get("human_readable")
 
     if new_name:
-        # Update the document's human_readable field
-        document.human_readable = new_name
+        # Update the document's human_readable field, unless it changed since the `revision` sent, if any
+        if not touch_doc(document.id, expected_revision=data.get("revision"), human_readable=new_name):
+            db.session.rollback()
+            document = db.session.get(Doc, doc_id)
+            return jsonify({"status": "conflict", "message": "The document was changed in the meantime",
+                            "human_readable": document.human_readable, "revision": document.revision}), 409
+        record_doc_change(document.id, user_id=current_user.id)
         db.session.commit()
         return jsonify({"status": "success"}), 200
     else:
@@ -115,33 +244,124 @@ def document_route(doc_id):
 @bp_main.route("/document/<int:doc_id>/line/<int:line_id>", methods=["POST"])
 @login_required
 def line_route(doc_id, line_id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "Expected a JSON object"}), 400
+    error = _line_update_error(dict(data, id=line_id))
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+
     try:
-        data = request.get_json()
+        # Update the line with new data, if it is still at the `version` sent
+        lines = apply_line_updates(doc_id, [dict(data, id=line_id)], user_id=current_user.id)
+        db.session.commit()
 
-        line = Line.query.get(line_id)
-        if not line:
-            return jsonify({"status": "error", "message": "Line not found"}), 404
+        return jsonify({"status": "success", "line_status": lines[line_id]["status"],
+                        "version": lines[line_id]["version"], "message": "Line updated successfully"})
+
+    except EditConflict as e:
+        db.session.rollback()
+        return jsonify({"status": "conflict", "message": str(e), "lines": e.lines}), 409
+    except LookupError:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": "Line not found"}), 404
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Saving line %s of document %s failed", line_id, doc_id)
+        return jsonify({"status": "error", "message": "The line could not be saved"}), 500
 
-        # Update the line with new data
-        line.update_from_dict(data)
-        db.session.commit()
 
-        return jsonify({"status": "success", "line_status": line.status, "message": "Line updated successfully"})
+@bp_main.route("/document/<int:doc_id>/lines", methods=["POST"])
+@login_required
+def lines_update_route(doc_id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or not data:
+        return jsonify({"status": "error", "message": "Expected a non-empty JSON array of line updates"}), 400
+    for index, update in enumerate(data):
+        error = _line_update_error(update)
+        if error:
+            return jsonify({"status": "error", "message": f"Line update {index}: {error}"}), 400
+    if len(data) > LINES_UPDATE_MAX:
+        return jsonify({"status": "error", "message": f"At most {LINES_UPDATE_MAX} lines per request"}), 400
 
-    except Exception as e:
+    try:
+        lines = apply_line_updates(doc_id, data, user_id=current_user.id)
+        db.session.commit()
+        return jsonify({
+            "status": "success",
+            "lines": {str(line_id): line["status"] for line_id, line in lines.items()},
+            "versions": {str(line_id): line["version"] for line_id, line in lines.items()},
+            "message": f"{len(lines)} lines updated successfully"
+        })
+
+    except EditConflict as e:
+        # Nothing is saved, the editor refreshes the conflicting lines and sends the others again
+        db.session.rollback()
+        return jsonify({"status": "conflict", "message": str(e), "lines": e.lines}), 409
+    except LookupError as e:
         db.session.rollback()
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return jsonify({"status": "error", "message": str(e)}), 404
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Saving lines of document %s failed", doc_id)
+        return jsonify({"status": "error", "message": "The lines could not be saved"}), 500
+
+
+@bp_main.route("/document/<int:doc_id>/lines", methods=["GET"])
+@login_required
+def lines_page_route(doc_id):
+    document = Doc.query.options(load_only(Doc.id, Doc.revision, Doc.updated_at)).get_or_404(doc_id)
+    limit = max(1, min(request.args.get("limit", LINES_PAGE_SIZE, type=int), LINES_UPDATE_MAX))
+
+    def build():
+        lines, text_start, text_slice = lines_page(
+            doc_id,
+            after_start=request.args.get("after_start", -1, type=int),
+            after_id=request.args.get("after_id", 0, type=int),
+            limit=limit
+        )
+        return jsonify({
+            "lines": lines,
+            "text_start": text_start,
+            "text": text_slice,
+            "next": {"after_start": lines[-1]["start"], "after_id": lines[-1]["id"]} if len(lines) == limit else None
+        })
+
+    return _conditional_response(_doc_etag(document, "lines"), document.updated_at, build)
+
+
+@bp_main.route("/document/<int:doc_id>/lines/changes", methods=["GET"])
+@login_required
+def lines_changes_route(doc_id):
+    """ Lines written after the document revision `since`, polled by open editors. A changed `lines_hash`
+    means the document was re-imported and its lines may have been removed.
+    """
+    document = Doc.query.options(load_only(Doc.id, Doc.revision, Doc.lines_hash)).get_or_404(doc_id)
+    since = request.args.get("since", 0, type=int)
+    return jsonify({
+        "revision": document.revision,
+        "lines_hash": document.lines_hash,
+        "lines": lines_changed_since(doc_id, since) if since < document.revision else []
+    })
 
 
 @bp_main.route("/document/<int:doc_id>/line") # Should deal with lines / page
 @login_required
 def lines_route(doc_id):
-    doc = Doc.query.get_or_404(doc_id)
+    doc = Doc.query.options(defer(Doc.text)).get_or_404(doc_id)
     if request.args.get("prettyPrint"):
-        return render_template(
-            "prettyPrint.html", lines=doc.lines, document=doc)
-    return render_template(
-        "lines.html", lines=doc.lines, document=doc)
+        return _page_response(
+            doc,
+            "prettyPrint",
+            # Streamed, so that long documents start showing before the whole table is rendered
+            lambda: Response(stream_template("prettyPrint.html", rows=doc_merged_rows(doc), document=doc))
+        )
+    # Lines and the text they cover are fetched by pages from lines_page_route
+    return _page_response(
+        doc,
+        "lines.html",
+        lambda: render_template("lines.html", document=doc, page_size=LINES_PAGE_SIZE)
+    )
 
 
 @bp_main.route("/guidelines") # Should deal with lines / page
@@ -154,20 +374,166 @@ def guidelines_route():
 def import_jsonl_route():
     form = UploadForm()
 
-    if request.method == "POST" and form.validate_on_submit():
-        file = form.file.data
-        if file:
-            # Convert the uploaded file into a BytesIO object
-            file_stream = io.BytesIO(file.read())  # Read the file content into memory
+    if request.method == "POST":
+        if not form.validate_on_submit():
+            return jsonify({"errors": form.errors}), 400
+        job = enqueue_upload(current_app._get_current_object(), form.file.data, user_id=current_user.id,
+                             upsert=form.upsert.data)
+        return jsonify({**job_json(job), "url": url_for("bp_main.import_job_route", job_id=job.id)}), 202
+
+    fail_orphaned_jobs()
+    jobs = select(ImportJob).order_by(ImportJob.id.desc()).limit(IMPORT_JOBS_LISTED)
+    if not current_user.is_admin:
+        jobs = jobs.where(ImportJob.user_id == current_user.id)
+    jobs = db.session.scalars(jobs).all()
+    return render_template("import.html", form=form, jobs=jobs, csrf_token=generate_csrf())
+
 
-            def generate():
-                # Pass the file stream directly to the import function (no need for readlines)
-                for message, cls, details in import_jsonl_stream(file_stream):
-                    if details == "bold":
-                        yield f"<div class='bg-{cls} text-dark bg-opacity-10' style='font-weight:bold;'>{message}</div><br>"
-                    else:
-                        yield f"<div class='bg-{cls} text-dark bg-opacity-10' style='font-size:smaller;'>{message}</div><br>"
+def _import_job_or_abort(job_id):
+    """ Import job of the current user, any job for administrators
+    """
+    job = ImportJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    return job
 
-            return Response(stream_with_context(generate()), content_type='text/html')
 
-    return render_template("import.html", form=form)
+@bp_main.route("/import/jobs/<int:job_id>", methods=["GET"])
+@login_required
+def import_job_route(job_id):
+    job = _import_job_or_abort(job_id)
+    if not job.finished:
+        fail_orphaned_jobs()
+    return jsonify(job_json(job))
+
+
+@bp_main.route("/import/jobs/<int:job_id>/cancel", methods=["POST"])
+@login_required
+def import_job_cancel_route(job_id):
+    error = _csrf_error()
+    if error:
+        return error
+    job = _import_job_or_abort(job_id)
+    request_cancel(job)
+    return jsonify(job_json(job))
+
+
+def _server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _csrf_error():
+    """ Error response if the X-CSRFToken header does not hold the token of the session, for the POST routes
+    which are not sent with a form: the token is checked as FlaskForm.validate_on_submit() does for forms
+    """
+    if not current_app.config.get("WTF_CSRF_ENABLED", True):
+        return None
+    try:
+        validate_csrf(request.headers.get("X-CSRFToken"))
+    except ValidationError as E:
+        return jsonify({"status": "error", "message": str(E)}), 400
+    return None
+
+
+def _import_counters(stats):
+    return {"documents": stats.documents, "lines": stats.lines, "uncovered": stats.uncovered,
+            "skipped": stats.skipped, "updated": stats.updated, "unchanged": stats.unchanged}
+
+
+@bp_main.route("/import/stream", methods=["POST"])
+@login_required
+def import_stream_route():
+    """ Import the JSONL request body as it is received, reporting Server-Sent Events: `progress` with the
+    counters every IMPORT_PROGRESS_INTERVAL seconds, `warning` for skipped documents and uncovered lines,
+    then `done` or `error`. With `?upsert=1`, existing documents are updated instead of skipped.
+
+    Each document is committed on its own: the next one is read from the network with no write transaction
+    open, so that a slow upload does not lock annotators out.
+
+    The body must be sent as application/x-ndjson with the CSRF token in the X-CSRFToken header, so that
+    another site cannot post it from a form.
+    """
+    error = _csrf_error()
+    if error:
+        return error
+    if request.mimetype != "application/x-ndjson":
+        return jsonify({"status": "error", "message": "Expected an application/x-ndjson body"}), 415
+    interval = current_app.config.get("IMPORT_PROGRESS_INTERVAL", 1.0)
+    upsert = bool(request.args.get("upsert", 0, type=int))
+    # Reading lines from the raw request stream would go byte per byte, only one buffer is held in memory
+    body = io.BufferedReader(request.stream, buffer_size=IMPORT_STREAM_BUFFER)
+
+    def generate():
+        stats = ImportStats()
+        last_progress = time.monotonic()
+        try:
+            for message, cls, details in import_jsonl_stream(body, stats=stats, verbose=False, upsert=upsert,
+                                                             commit_every=1):
+                if cls == "warning":
+                    yield _server_sent_event("warning", {"message": message})
+                if time.monotonic() - last_progress >= interval:
+                    yield _server_sent_event("progress", _import_counters(stats))
+                    last_progress = time.monotonic()
+        except Exception as E:
+            current_app.logger.exception("Streamed import failed")
+            yield _server_sent_event("error", {**_import_counters(stats), "message": f"{type(E).__name__}: {E}"})
+            return
+        yield _server_sent_event("done", {**_import_counters(stats), "message": stats.summary()})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@bp_main.route("/admin/lines/bulk", methods=["POST"])
+@login_required
+def bulk_lines_route():
+    """ Set the status of every line matching filters, e.g.
+    `{"set_status": "Excluded", "filters": {"canonical_regex": "^[|.]+$"}, "dry_run": true}`. A dry run only
+    counts the lines and documents which would change.
+    """
+    if not current_user.is_admin:
+        abort(403)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("filters", {}), dict) or not data.get("set_status"):
+        return jsonify({"status": "error", "message": "Expected a JSON object with set_status and filters"}), 400
+    filters = data.get("filters", {})
+
+    try:
+        if data.get("dry_run"):
+            lines, documents = count_lines(filters, data["set_status"])
+        else:
+            lines, documents = 0, 0
+            for lines, documents in set_lines_status(filters, data["set_status"], user_id=current_user.id):
+                pass
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({"status": "error", "message": str(e)}), 400
+    verb = "would be set" if data.get("dry_run") else "set"
+    return jsonify({
+        "status": "success",
+        "dry_run": bool(data.get("dry_run")),
+        "lines": lines,
+        "documents": documents,
+        "message": f"{lines} lines in {documents} documents {verb} to {data['set_status']}"
+    })
+
+
+@bp_main.route("/admin/throughput", methods=["GET"])
+@login_required
+def throughput_route():
+    """ Line edits per hour or day (`period`) and user or document (`by`), from `since` (ISO date) onwards
+    """
+    if not current_user.is_admin:
+        abort(403)
+    period = request.args.get("period", "day")
+    by = request.args.get("by", "user")
+    if period not in ROLLUP_PERIODS or by not in ("user", "doc"):
+        return jsonify({"status": "error", "message": "period must be hour or day, by user or doc"}), 400
+    try:
+        since = datetime.datetime.fromisoformat(request.args["since"]) if request.args.get("since") else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "since must be an ISO date"}), 400
+    if since is not None and since.tzinfo is not None:
+        since = since.astimezone(datetime.UTC).replace(tzinfo=None)  # Rollups are in naive UTC
+    return jsonify({"period": period, "by": by, "cursor": journal_cursor(),
+                    "results": throughput(period, by=by, since=since)})
@@ -0,0 +1,141 @@
+""" Set-based bulk status changes of lines across the corpus, e.g. excluding every line whose source matches
+a noise pattern or resetting a document to Pending.
+
+Lines are selected with filters and updated by chunks of BULK_CHUNK_SIZE ids, each in its own short
+transaction: the chunk is read in id order, journaled and updated with a single INSERT ... SELECT and a
+single UPDATE, and the counters and revision of its documents and the abbreviation index are updated before
+the commit, so that annotators only wait for one chunk at a time.
+"""
+import collections
+import re
+
+from sqlalchemy import select, insert, update, func, or_, tuple_, literal, Integer, DateTime
+
+from .db import (db, Doc, Line, LineEdit, utcnow, touch_doc, status_counter, abbreviation_pairs, update_abbreviations,
+                 add_edit_rollups)
+
+BULK_CHUNK_SIZE = 5000  # Lines updated per transaction
+STATUSES = ("Pending", "Validated", "Excluded")
+FILTERS = ("doc_ids", "status", "canonical", "normalized", "canonical_regex", "normalized_regex",
+           "normalized_is_canonical")
+
+
+def line_criteria(filters):
+    """ WHERE criteria of the lines matching a dict of FILTERS: documents ids, current status, exact
+    canonical or normalized value, Python regular expressions searched in them, normalized equal to canonical.
+    Raises ValueError on unknown filters, values of the wrong type or invalid regular expressions.
+    """
+    unknown = set(filters) - set(FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}")
+    doc_ids = filters.get("doc_ids")
+    if doc_ids is not None and (
+        not isinstance(doc_ids, (list, tuple))
+        or not all(isinstance(doc_id, int) and not isinstance(doc_id, bool) for doc_id in doc_ids)
+    ):
+        raise ValueError("doc_ids must be a list of document ids")
+    for name in ("status", "canonical", "normalized", "canonical_regex", "normalized_regex"):
+        if filters.get(name) is not None and not isinstance(filters[name], str):
+            raise ValueError(f"{name} must be a string")
+
+    criteria = []
+    if doc_ids:
+        criteria.append(Line.doc_id.in_(doc_ids))
+    if filters.get("status"):
+        criteria.append(Line.status == filters["status"].capitalize())  # Stored as in STATUSES
+    for field in ("canonical", "normalized"):
+        if filters.get(field) is not None:
+            criteria.append(getattr(Line, field) == filters[field])
+        pattern = filters.get(f"{field}_regex")
+        if pattern:
+            try:
+                re.compile(pattern)
+            except re.error as E:
+                raise ValueError(f"Invalid {field}_regex: {E}")
+            criteria.append(getattr(Line, field).regexp_match(pattern))
+    if filters.get("normalized_is_canonical"):
+        criteria.append(Line.normalized == Line.canonical)
+    return criteria
+
+
+def _needs_change(new_status):
+    if not isinstance(new_status, str) or new_status not in STATUSES:
+        raise ValueError(f"Status must be one of {', '.join(STATUSES)}")
+    return or_(Line.status.is_(None), Line.status != new_status)
+
+
+def count_lines(filters, new_status):
+    """ Dry run: number of lines and documents a status change would touch
+    """
+    lines, documents = db.session.execute(
+        select(func.count(Line.id), func.count(func.distinct(Line.doc_id)))
+        .where(*line_criteria(filters), _needs_change(new_status))
+    ).one()
+    return lines, documents
+
+
+def set_lines_status(filters, new_status, chunk_size=BULK_CHUNK_SIZE, user_id=None):
+    """ Set the status of the lines matching filters by chunks, committing each chunk with its journal
+    entries under `user_id`. Yields the running (lines, documents) totals after every chunk.
+
+    Counters and abbreviations are computed from the chunk as it was read, so the UPDATE only applies to lines
+    still at the version read, as in apply_line_updates(). If an annotator saved one of them in between, the
+    chunk is rolled back and read again.
+    """
+    criteria = [*line_criteria(filters), _needs_change(new_status)]
+    validated = new_status == "Validated"
+    rollup_column = status_counter(new_status).removesuffix("_count")
+
+    lines = 0
+    documents = set()
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Line.id, Line.doc_id, Line.status, Line.canonical, Line.normalized, Line.version)
+            .where(Line.id > last_id, *criteria)
+            .order_by(Line.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+
+        ids = [row.id for row in rows]
+        now = utcnow()
+        db.session.execute(insert(LineEdit.__table__).from_select(
+            ["line_id", "doc_id", "user_id", "created_at", "old_status", "new_status", "old_normalized",
+             "new_normalized", "old_merge", "new_merge"],
+            select(Line.id, Line.doc_id, literal(user_id, Integer), literal(now, DateTime), Line.status,
+                   literal(new_status), Line.normalized, Line.normalized, Line.merge, Line.merge)
+            .where(Line.id.in_(ids))
+        ))
+        transitions = collections.defaultdict(list)
+        abbreviations = collections.Counter()
+        for row in rows:
+            transitions[row.doc_id].append((row.status, new_status))
+            # Only lines entering or leaving Validated change the abbreviation index
+            delta = validated - ((row.status or "").lower() == "validated")
+            if delta:
+                for pair in abbreviation_pairs(row.canonical, row.normalized):
+                    abbreviations[pair] += delta
+        for doc_id, doc_transitions in transitions.items():
+            touch_doc(doc_id, doc_transitions)
+        # Lines take the new revision of their document as version, so that open editors see the change
+        table = Line.__table__
+        result = db.session.execute(
+            update(table).where(tuple_(table.c.id, table.c.version).in_([(row.id, row.version) for row in rows]))
+            .values(status=new_status, version=select(Doc.revision).where(Doc.id == table.c.doc_id).scalar_subquery())
+        )
+        if result.rowcount != len(rows):  # Saved by an annotator since the chunk was read
+            db.session.rollback()
+            continue
+        update_abbreviations(abbreviations)
+        add_edit_rollups({
+            doc_id: collections.Counter({"edits": len(doc_transitions), rollup_column: len(doc_transitions)})
+            for doc_id, doc_transitions in transitions.items()
+        }, user_id, now)
+        db.session.commit()
+
+        lines += len(rows)
+        documents.update(transitions)
+        last_id = rows[-1].id
+        yield lines, len(documents)
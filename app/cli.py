@@ -0,0 +1,157 @@
+""" Command line interface: `flask db ...`, `flask lines ...` and `flask import`.
+
+Commands run in an application context and only need the database, the web part of the application is not
+initialised for them, see create_app().
+"""
+import click
+from flask.cli import AppGroup, with_appcontext
+
+from .db import db, User, import_jsonl_stream, rebuild_doc_counters, iter_doc_exports, rebuild_abbreviations
+from .bulk import count_lines, set_lines_status, STATUSES, BULK_CHUNK_SIZE
+from . import search, schema
+
+db_group = AppGroup("db")
+lines_group = AppGroup("lines", help="Bulk operations on lines")
+
+
+@db_group.command("create")
+@click.option("--admin/--no-admin", is_flag=True, default=True)
+@click.option("--admin-name", type=str, default="admin")
+@click.option("--admin-password", type=str, default="qwerty")
+def db_create(admin, admin_name, admin_password):
+    db.create_all()
+    if search.is_supported():
+        search.create_index()
+    click.echo("DB Created")
+    if admin:
+        admin = User(username=admin_name, is_admin=True, is_approved=True)
+        admin.set_password(admin_password)
+        db.session.add(admin)
+        db.session.commit()
+        click.echo("Admin created")
+
+
+@db_group.command("reset")
+def db_reset():
+    db.drop_all()
+    db.create_all()
+    if search.is_supported():
+        search.rebuild_index()
+    click.echo("DB Recreated")
+
+
+@db_group.command("drop")
+def db_drop():
+    db.drop_all()
+    if search.is_supported():
+        search.drop_index()
+    click.echo("DB Dropped")
+
+
+@db_group.command("rebuild-counters")
+def db_rebuild_counters():
+    documents = rebuild_doc_counters()
+    click.echo(f"Counters rebuilt for {documents} documents")
+
+
+@db_group.command("rebuild-abbreviations")
+def db_rebuild_abbreviations():
+    pairs = rebuild_abbreviations()
+    click.echo(f"Abbreviation index rebuilt with {pairs} pairs")
+
+
+@db_group.command("upgrade")
+def db_upgrade():
+    changes = schema.upgrade_schema()
+    if search.is_supported() and not search.index_ready():
+        search.rebuild_index()
+        changes.append("Built search index")
+    for change in changes:
+        click.echo(change)
+    click.echo("DB Upgraded" if changes else "DB already up to date")
+
+
+@db_group.command("explain")
+def db_explain():
+    if db.engine.dialect.name != "sqlite":
+        click.echo("Query plans are only available with SQLite")
+        return
+    full_scans = 0
+    for name, sql, plan, scans in schema.explain_queries():
+        click.echo(f"== {name}")
+        click.echo(sql)
+        for step in plan:
+            click.echo(f"  {'!! ' if step in scans else ''}{step}")
+        full_scans += len(scans)
+    click.echo(f"{full_scans} full table scans")
+
+
+@db_group.command("reindex")
+def db_reindex():
+    if not search.is_supported():
+        click.echo("Full-text search is only available with SQLite")
+        return
+    search.rebuild_index()
+    click.echo("Search index rebuilt")
+
+
+@db_group.command("warm-cache")
+def db_warm_cache():
+    documents = sum(1 for _ in iter_doc_exports())
+    click.echo(f"Exports cached for {documents} documents")
+
+
+@lines_group.command("set-status")
+@click.argument("status", type=click.Choice(STATUSES, case_sensitive=False))
+@click.option("--doc", "doc_ids", type=int, multiple=True, help="Only lines of this document (repeatable)")
+@click.option("--status", "current_status", type=str, default=None, help="Only lines with this current status")
+@click.option("--canonical", type=str, default=None, help="Only lines whose source text equals this value")
+@click.option("--normalized", type=str, default=None, help="Only lines whose normalized text equals this value")
+@click.option("--canonical-regex", type=str, default=None, help="Only lines whose source text matches this regex")
+@click.option("--normalized-regex", type=str, default=None,
+              help="Only lines whose normalized text matches this regex")
+@click.option("--normalized-is-canonical", is_flag=True, default=False,
+              help="Only lines whose normalized text equals their source text")
+@click.option("--chunk-size", type=int, default=BULK_CHUNK_SIZE, help="Lines updated per transaction")
+@click.option("--dry-run", is_flag=True, default=False, help="Only count the lines which would change")
+def lines_set_status(status, doc_ids, current_status, canonical, normalized, canonical_regex, normalized_regex,
+                     normalized_is_canonical, chunk_size, dry_run):
+    status = status.capitalize()
+    filters = {"doc_ids": doc_ids, "status": current_status, "canonical": canonical, "normalized": normalized,
+               "canonical_regex": canonical_regex, "normalized_regex": normalized_regex,
+               "normalized_is_canonical": normalized_is_canonical}
+    try:
+        if dry_run:
+            lines, documents = count_lines(filters, status)
+            click.echo(f"{lines} lines in {documents} documents would be set to {status}")
+            return
+        lines, documents = 0, 0
+        for lines, documents in set_lines_status(filters, status, chunk_size=chunk_size):
+            click.echo(f"{lines} lines in {documents} documents updated")
+    except ValueError as E:
+        raise click.BadParameter(str(E))
+    click.echo(f"{lines} lines in {documents} documents set to {status}")
+
+
+@click.command("import")
+@click.argument("jsonl")
+@click.option("--batch-size", type=int, default=None, help="Lines inserted per executemany batch")
+@click.option("--commit-every", type=int, default=None, help="Documents imported per transaction")
+@click.option("--workers", type=int, default=1, help="Processes used to parse the JSONL records")
+@click.option("--upsert", is_flag=True, default=False,
+              help="Update the documents which already exist instead of skipping them, keeping the annotations "
+                   "of unchanged lines")
+@with_appcontext
+def import_(jsonl, batch_size, commit_every, workers, upsert):
+    with open(jsonl) as f:
+        for x, *_ in import_jsonl_stream(f, workers=workers, batch_size=batch_size,
+                                         commit_every=commit_every, upsert=upsert):
+            print(x.strip())
+
+
+def init_cli(app):
+    """ Register the commands on the app
+    """
+    app.cli.add_command(db_group)
+    app.cli.add_command(lines_group)
+    app.cli.add_command(import_)
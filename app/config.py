@@ -0,0 +1,96 @@
+""" Configuration of the application and of its database engine.
+
+Defaults are overridden, in this order, by the Python file named by the PARAMHTRS_SETTINGS environment variable
+and by PARAMHTRS_-prefixed environment variables, e.g.:
+
+    PARAMHTRS_SQLALCHEMY_DATABASE_URI=postgresql://user@host/paramhtrs
+    PARAMHTRS_SQLITE_PRAGMAS__busy_timeout=10000
+    PARAMHTRS_DATABASE_POOL__pool_size=20
+"""
+import copy
+import os
+import weakref
+
+from sqlalchemy import event
+
+DEFAULTS = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///data.db",  # Use SQLite for simplicity
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    "SECRET_KEY": "RandomKey",
+    # Applied to every new SQLite connection: WAL lets readers (e.g. an export) run while annotators write,
+    # busy_timeout makes writers wait for the lock instead of failing with "database is locked"
+    "SQLITE_PRAGMAS": {
+        "journal_mode": "WAL",
+        "busy_timeout": 10000,  # ms
+        "synchronous": "NORMAL",
+        "cache_size": -65536,  # KiB when negative
+        "mmap_size": 268435456,  # bytes
+        "temp_store": "MEMORY",
+    },
+    # Per-endpoint SQL and latency histograms at /metrics, see app/metrics.py
+    "METRICS_ENABLED": False,
+    "METRICS_SLOW_QUERY_MS": 200,
+    # Seconds a user loaded for a request is reused by the next requests of the process, 0 to disable
+    "USER_CACHE_TTL": 60,
+    # Background imports of uploaded files, see app/jobs.py
+    "IMPORT_JOB_WORKERS": 1,  # SQLite has a single writer, more threads only wait for its lock
+    "IMPORT_PROGRESS_INTERVAL": 1.0,  # seconds
+    "IMPORT_SPOOL_DIR": None,  # Defaults to instance/imports
+    # Connection pool of server databases such as PostgreSQL, ignored for SQLite
+    "DATABASE_POOL": {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+    },
+}
+
+
+def load_config(app, config=None):
+    """ Fill the app configuration from the defaults, the settings file, the environment and `config`
+    """
+    app.config.update(copy.deepcopy(DEFAULTS))
+    app.config.from_envvar("PARAMHTRS_SETTINGS", silent=True)
+    app.config.from_prefixed_env("PARAMHTRS")
+    if config:
+        app.config.update(config)
+
+    engine_options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        for key, value in app.config["DATABASE_POOL"].items():
+            engine_options.setdefault(key, value)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+
+
+def register_sqlite_pragmas(app, engine):
+    """ Run the SQLITE_PRAGMAS on every connection the engine opens
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = dict(app.config.get("SQLITE_PRAGMAS") or {})
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+_forked_engines = weakref.WeakSet()
+
+
+def dispose_after_fork(engine):
+    """ Drop the connections the engine inherited when the process forks, e.g. into the workers of a server
+    which preloaded the app, so that each process opens its own
+    """
+    _forked_engines.add(engine)
+
+
+def _dispose_engines():
+    for engine in list(_forked_engines):
+        engine.dispose(close=False)  # The parent keeps using its connections, they must not be closed here
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispose_engines)
@@ -1,14 +1,25 @@
+import collections
+import datetime
+import functools
+import hashlib
 import json
+import multiprocessing
+import time
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from flask import current_app
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import func
+from sqlalchemy import func, insert, select, update, delete, case, and_, or_, bindparam, tuple_
+from sqlalchemy.orm import defer, selectinload
 
 db = SQLAlchemy()
 
 
+def utcnow():
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -28,7 +39,20 @@ class Doc(db.Model):
     title = db.Column(db.String(255), unique=True, nullable=False)  # Ensure unique title
     text = db.Column(db.Text, nullable=False)
     human_readable = db.Column(db.String(255), nullable=True)  # Add human-readable name
-    lines = db.relationship("Line", backref="doc", cascade="all, delete-orphan", lazy=True)
+    lines = db.relationship("Line", backref="doc", cascade="all, delete-orphan", lazy=True,
+                            order_by="[Line.start, Line.id]")
+    export = db.relationship("DocExport", cascade="all, delete-orphan", lazy=True, uselist=False)
+    # Line counters per status, kept up to date by the importers and line edits
+    lines_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    validated_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    excluded_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    pending_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Bumped by every change of the document or of its lines, used as ETag and as version of the document
+    revision = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=True, default=utcnow)
+    # SHA-256 of the text and of the (start, canonical) of the lines as imported, see record_hashes()
+    text_hash = db.Column(db.String(64), nullable=True)
+    lines_hash = db.Column(db.String(64), nullable=True)
 
     @property
     def displayable_title(self):
@@ -36,17 +60,12 @@ class Doc(db.Model):
 
     @property
     def validation_percentage(self):
-        # Total number of lines in the document
-        total_lines = db.session.query(func.count(Line.id)).filter(Line.doc_id == self.id).scalar()
-        # Number of validated lines
-        validated_lines = db.session.query(func.count(Line.id)).filter(Line.doc_id == self.id,
-                                                                       Line.status != "Pending").scalar()
-
-        # Calculate the validation percentage
-        return round((validated_lines / total_lines * 100) if total_lines > 0 else 0.0, 1)
+        # Share of lines which are not pending anymore
+        done_lines = self.lines_count - self.pending_count
+        return round((done_lines / self.lines_count * 100) if self.lines_count > 0 else 0.0, 1)
 
     def json(self):
-        lines = []
+        validated = []
         excluded = []
         for line in self.lines:
             if line.status.lower() == "excluded":
@@ -54,26 +73,60 @@ class Doc(db.Model):
                     "abbr": line.canonical.strip("\n"),
                     "expan": line.normalized.strip("\n")
                 })
-                continue
-            elif line.status.lower() != "validated":
-                continue
+            elif line.status.lower() == "validated":
+                validated.append((line.canonical.strip("\n"), line.normalized.strip("\n"), line.merge))
 
-            if line.merge and lines:
-                lines[-1]["abbr"] += line.canonical.strip("\n")
-                lines[-1]["expan"] += line.normalized.strip("\n")
-            else:
-                lines.append({
-                    "abbr": line.canonical.strip("\n"),
-                    "expan": line.normalized.strip("\n")
-                })
         return {
             "source": self.title,
             "readable": self.human_readable,
-            "lines": lines,
+            "lines": [
+                {"abbr": "".join(canonicals), "expan": "".join(normalizeds)}
+                for canonicals, normalizeds in merged_rows(validated)
+            ],
             "excluded": excluded
         }
 
 
+def merged_rows(lines):
+    """ Fold (canonical, normalized, merge) lines into rows: a line flagged `merge` joins the row of the
+    previous line. Returns a tuple of (canonical parts, normalized parts) rows.
+    """
+    rows = []
+    for canonical, normalized, merge in lines:
+        if merge and rows:
+            rows[-1][0].append(canonical)
+            rows[-1][1].append(normalized)
+        else:
+            rows.append(([canonical], [normalized]))
+    return tuple((tuple(canonicals), tuple(normalizeds)) for canonicals, normalizeds in rows)
+
+
+MERGED_ROWS_CACHE_SIZE = 64  # Documents whose merged rows are kept in memory by each process
+
+
+@functools.lru_cache(maxsize=MERGED_ROWS_CACHE_SIZE)
+def _cached_merged_rows(database, doc_id, revision):
+    return merged_rows(db.session.execute(
+        select(Line.canonical, func.coalesce(Line.normalized, ""), Line.merge)
+        .where(Line.doc_id == doc_id)
+        .order_by(Line.start, Line.id)
+    ))
+
+
+def doc_merged_rows(document):
+    """ Merged rows of all the lines of a document, computed once per revision
+    """
+    return _cached_merged_rows(str(db.engine.url), document.id, document.revision)
+
+
+class DocExport(db.Model):
+    """ Serialized Doc.json() of a document, valid as long as the document is at the same revision
+    """
+    doc_id = db.Column(db.Integer, db.ForeignKey("doc.id"), primary_key=True)
+    revision = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+
+
 class Line(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Auto-increment ID
     start = db.Column(db.Integer, nullable=False)
@@ -82,6 +135,14 @@ class Line(db.Model):
     status = db.Column(db.String(50), default="Pending")
     merge = db.Column(db.Boolean, default=False)
     doc_id = db.Column(db.Integer, db.ForeignKey("doc.id"), nullable=False)  # Relationship to Doc
+    # Revision of the document when the line was last written: checked by edits based on it and used to
+    # poll the lines changed since a revision, see apply_line_updates() and lines_changed_since()
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    __table_args__ = (
+        db.Index("ix_line_doc_start", "doc_id", "start"),  # Doc.lines order and keyset pages
+        db.Index("ix_line_doc_status", "doc_id", "status"),  # Counters and status filters per document
+    )
 
     @property
     def status_css(self):
@@ -107,93 +168,815 @@ class Line(db.Model):
         self.status = data.get("status", self.status)
 
 
-def import_prepared_doc(jdoc):
-    """ Import a more prepared format
+class ImportJob(db.Model):
+    """ JSONL upload spooled to disk and imported in the background, see app/jobs.py
     """
-    try:
-        # Check if document already exists
-        existing_doc = Doc.query.filter_by(title=jdoc["title"]).first()
-        if existing_doc:
-            yield f"Document with ID {jdoc["title"]} already exists. Skipping...", "warning", "bold"
-            return
-
-        doc = Doc(title=jdoc["title"], human_readable=jdoc["human_readable"], text=jdoc["text"])
-        db.session.add(doc)
-        db.session.flush()
-        yield f"Document {jdoc["title"]} created successfully.", "success", "bold"
-
-        start = 0
-        for line in jdoc["lines"]:
-            line = Line(canonical=line["abbr"], normalized=line["expan"], merge=line["merge"], start=start,
-                 doc_id=doc.id)
-            db.session.add(line)
-            start += len(line.canonical+"\n")
-            yield f"Line added: {line.canonical}", "info", ""
-
-        db.session.commit()  # Save all lines
-        yield f"Document `{doc.human_readable}` import completed.", "success", ""
-    except Exception as E:
-        db.session.rollback()
-        raise E
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    filename = db.Column(db.String(255), nullable=False)  # Name of the uploaded file
+    path = db.Column(db.String(1024), nullable=False)  # Spooled copy, removed once the job is over
+    status = db.Column(db.String(50), nullable=False, default="Queued")  # Queued, Running, Completed, Failed, Cancelled
+    worker = db.Column(db.String(255), nullable=True)  # host:pid of the process which queued it, see app/jobs.py
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False, server_default="0")
+    upsert = db.Column(db.Boolean, nullable=False, default=False, server_default="0")  # See upsert_doc()
+    documents = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    lines = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    uncovered = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    skipped = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    updated = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    unchanged = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    message = db.Column(db.Text, nullable=True)  # Summary of the import or error
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    FINISHED = ("Completed", "Failed", "Cancelled")
+
+    @property
+    def finished(self):
+        return self.status in self.FINISHED
+
+    def json(self):
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "finished": self.finished,
+            "cancel_requested": self.cancel_requested,
+            "upsert": self.upsert,
+            "documents": self.documents,
+            "lines": self.lines,
+            "uncovered": self.uncovered,
+            "skipped": self.skipped,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "message": self.message,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+        }
+
+
+class Abbreviation(db.Model):
+    """ Abbreviation to expansion token pair, with the number of times validated lines use it, see
+    abbreviation_pairs()
+    """
+    abbr = db.Column(db.String(255), primary_key=True)
+    expan = db.Column(db.String(255), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index("ix_abbreviation_abbr_count", "abbr", "count"),  # Most frequent expansions of an abbreviation
+    )
+
+
+class LineEdit(db.Model):
+    """ Append-only journal of line edits with the values before and after, see record_line_edits().
+    Its id is the cursor of incremental exports. It has no secondary index and no foreign key, so that an
+    entry costs a single append and outlives the lines and documents it refers to.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    line_id = db.Column(db.Integer, nullable=False)  # 0 for changes of the document itself, see record_doc_change()
+    doc_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)  # None for command line edits
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    old_status = db.Column(db.String(50), nullable=True)
+    new_status = db.Column(db.String(50), nullable=True)
+    old_normalized = db.Column(db.Text, nullable=True)
+    new_normalized = db.Column(db.Text, nullable=True)
+    old_merge = db.Column(db.Boolean, nullable=True)
+    new_merge = db.Column(db.Boolean, nullable=True)
+
+
+class EditRollup(db.Model):
+    """ Line edits per hour or day, user and document, added to by record_line_edits() so that throughput
+    is read without scanning the journal
+    """
+    period = db.Column(db.String(4), primary_key=True)  # hour or day
+    start = db.Column(db.DateTime, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)  # 0 for command line edits
+    doc_id = db.Column(db.Integer, primary_key=True)
+    edits = db.Column(db.Integer, nullable=False, default=0)
+    # Lines set to each status, and lines whose normalized form changed
+    validated = db.Column(db.Integer, nullable=False, default=0)
+    excluded = db.Column(db.Integer, nullable=False, default=0)
+    pending = db.Column(db.Integer, nullable=False, default=0)
+    normalized = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Backs the ORDER BY of the document list
+db.Index("ix_doc_display_order", func.lower(Doc.human_readable), func.lower(Doc.title))
+
+
+EXPORT_CHUNK_SIZE = 100  # Documents exported at once
+IMPORT_BATCH_SIZE = 5000  # Lines sent to the database per executemany
+IMPORT_COMMIT_EVERY = 50  # Documents per transaction
+
+
+class ImportStats:
+    """ Running counters of an import, used to report its throughput
+    """
+    COUNTERS = ("documents", "lines", "uncovered", "skipped", "updated", "unchanged")
+
+    def __init__(self):
+        self.documents = 0
+        self.lines = 0
+        self.uncovered = 0
+        self.skipped = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.started = time.perf_counter()
+        self.checkpoint()
+
+    def checkpoint(self):
+        """ Remember the counters, when the import commits
+        """
+        self.committed = {name: getattr(self, name) for name in self.COUNTERS}
+
+    def restore(self):
+        """ Put the counters back to the last checkpoint, when the import is rolled back
+        """
+        for name, value in self.committed.items():
+            setattr(self, name, value)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def lines_per_second(self):
+        elapsed = self.elapsed
+        return self.lines / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        summary = (f"Imported {self.documents} documents and {self.lines} lines in {self.elapsed:.1f}s "
+                   f"({self.lines_per_second:.0f} lines/s), {self.skipped} documents skipped.")
+        if self.updated or self.unchanged:
+            summary += f" {self.updated} documents updated, {self.unchanged} unchanged."
+        return summary
+
+
+def lines_page(doc_id, after_start=-1, after_id=0, limit=100):
+    """ Fetch the lines of a document following (after_start, after_id) in (start, id) order, with the
+    slice of the document text they cover.
+
+    Returns the lines as dicts, the offset of the text slice in Doc.text and the slice itself.
+    """
+    rows = db.session.execute(
+        select(Line.id, Line.start, func.length(Line.canonical).label("length"), Line.normalized, Line.merge,
+               Line.status, Line.version)
+        .where(Line.doc_id == doc_id, tuple_(Line.start, Line.id) > tuple_(after_start, after_id))
+        .order_by(Line.start, Line.id)
+        .limit(limit)
+    ).all()
+    lines = [
+        {"id": row.id, "start": row.start, "end": row.start + row.length, "normalized": row.normalized,
+         "merge": row.merge, "status": row.status, "version": row.version}
+        for row in rows
+    ]
+    if not lines:
+        return lines, 0, ""
+
+    text_start = min(line["start"] for line in lines)
+    text_end = max(line["end"] for line in lines)
+    text_slice = db.session.scalar(
+        select(func.substr(Doc.text, text_start + 1, text_end - text_start)).where(Doc.id == doc_id)
+    )
+    return lines, text_start, text_slice
+
+
+def iter_doc_exports(*criteria, chunk_size=EXPORT_CHUNK_SIZE):
+    """ Yield (doc id, serialized export) for the documents matching criteria, in id order.
+
+    Cached exports are read by chunks; the missing or outdated ones of a chunk are computed with their
+    lines loaded at once, stored and committed before the chunk is yielded.
+    """
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Doc.id, DocExport.payload)
+            .outerjoin(DocExport, and_(DocExport.doc_id == Doc.id, DocExport.revision == Doc.revision))
+            .where(Doc.id > last_id, *criteria)
+            .order_by(Doc.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+
+        refreshed = {}
+        missing = [doc_id for doc_id, payload in rows if payload is None]
+        if missing:
+            docs = db.session.scalars(
+                select(Doc).where(Doc.id.in_(missing)).options(defer(Doc.text), selectinload(Doc.lines))
+            ).all()
+            refreshed = {document.id: json.dumps(document.json()) for document in docs}
+            db.session.execute(delete(DocExport).where(DocExport.doc_id.in_(missing)))
+            db.session.execute(insert(DocExport), [
+                {"doc_id": document.id, "revision": document.revision, "payload": refreshed[document.id]}
+                for document in docs
+            ])
+            db.session.commit()
+
+        for doc_id, payload in rows:
+            yield doc_id, payload if payload is not None else refreshed[doc_id]
+        last_id = rows[-1][0]
+
+
+def doc_export(doc_id):
+    """ Serialized export of a single document, from the cache when it is up to date
+    """
+    for _, payload in iter_doc_exports(Doc.id == doc_id):
+        return payload
+
+
+def status_counter(status):
+    """ Name of the Doc counter a line with this status is counted in
+    """
+    if status is None or status.lower() == "pending":
+        return "pending_count"
+    elif status.lower() == "validated":
+        return "validated_count"
+    return "excluded_count"
+
+
+def touch_doc(doc_id, transitions=(), added=(), removed=(), expected_revision=None, **values):
+    """ Bump the revision of a document and apply a list of (old status, new status) line transitions
+    and the statuses of added and removed lines to its counters, in one UPDATE setting any other `values`.
+    With `expected_revision`, the document is only updated if it is still at this revision.
+
+    Returns whether the document was updated.
+    """
+    deltas = collections.Counter()
+    for old_status, new_status in transitions:
+        deltas[status_counter(old_status)] -= 1
+        deltas[status_counter(new_status)] += 1
+    for status in added:
+        deltas[status_counter(status)] += 1
+        deltas["lines_count"] += 1
+    for status in removed:
+        deltas[status_counter(status)] -= 1
+        deltas["lines_count"] -= 1
+    values.update({name: getattr(Doc, name) + delta for name, delta in deltas.items() if delta})
+    criteria = [Doc.id == doc_id]
+    if expected_revision is not None:
+        criteria.append(Doc.revision == expected_revision)
+    result = db.session.execute(
+        update(Doc).where(*criteria).values(revision=Doc.revision + 1, updated_at=utcnow(), **values)
+    )
+    return result.rowcount > 0
+
+
+ABBREVIATION_MAX_LENGTH = 100  # Longer tokens are left out of the abbreviation index
+ABBREVIATION_BATCH_SIZE = 5000  # Lines read and pairs written at once by rebuild_abbreviations()
+ABBREVIATION_MIN_PREFIX = 2  # Shorter queries match exactly, a one character prefix would sort too many pairs
+
+
+def abbreviation_pairs(canonical, normalized):
+    """ Token pairs (abbreviation, expansion) of a line: both sides are split on whitespace and paired by
+    position when they have as many tokens. Identical tokens are left out.
+    """
+    abbreviations = canonical.split()
+    expansions = (normalized or "").split()
+    if len(abbreviations) != len(expansions):
+        return []
+    return [
+        (abbr, expan) for abbr, expan in zip(abbreviations, expansions)
+        if abbr != expan and len(abbr) <= ABBREVIATION_MAX_LENGTH and len(expan) <= ABBREVIATION_MAX_LENGTH
+    ]
+
+
+def validated_pairs(line):
+    """ Abbreviation pairs a line, a mapping with canonical, normalized and status, adds to the index
+    """
+    if (line["status"] or "").lower() != "validated":
+        return []
+    return abbreviation_pairs(line["canonical"], line["normalized"])
+
 
-def import_jsonl_stream(file_stream):
-    for line in file_stream:
-        j = json.loads(line)
+def upsert_insert(model):
+    """ INSERT of the database dialect, which supports ON CONFLICT DO UPDATE
+    """
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(model)
+
+
+def update_abbreviations(deltas):
+    """ Add a Counter of (abbreviation, expansion) deltas to the index, pairs which are not used anymore
+    are removed
+    """
+    deltas = {pair: delta for pair, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    statement = upsert_insert(Abbreviation)
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[Abbreviation.abbr, Abbreviation.expan],
+            set_={"count": Abbreviation.count + statement.excluded.count}
+        ),
+        [{"abbr": abbr, "expan": expan, "count": delta} for (abbr, expan), delta in deltas.items()]
+    )
+    if any(delta < 0 for delta in deltas.values()):
+        db.session.execute(delete(Abbreviation).where(
+            tuple_(Abbreviation.abbr, Abbreviation.expan).in_([pair for pair, delta in deltas.items() if delta < 0]),
+            Abbreviation.count <= 0
+        ))
+
+
+def rebuild_abbreviations(batch_size=ABBREVIATION_BATCH_SIZE):
+    """ Recompute the abbreviation index from the validated lines, returns the number of pairs
+    """
+    counts = collections.Counter()
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Line.id, Line.canonical, Line.normalized)
+            .where(Line.id > last_id, func.lower(Line.status) == "validated")
+            .order_by(Line.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        for row in rows:
+            counts.update(abbreviation_pairs(row.canonical, row.normalized))
+        last_id = rows[-1].id
+
+    db.session.execute(delete(Abbreviation))
+    pairs = [{"abbr": abbr, "expan": expan, "count": count} for (abbr, expan), count in counts.items()]
+    for index in range(0, len(pairs), batch_size):
+        db.session.execute(insert(Abbreviation), pairs[index:index + batch_size])
+    db.session.commit()
+    return len(pairs)
+
+
+def abbreviations_query(search_query, exact=False, limit=10):
+    """ Most frequent expansions of the abbreviations equal to, or starting with, search_query
+    """
+    if exact:
+        criteria = [Abbreviation.abbr == search_query]
+    else:
+        # A range on the primary key rather than LIKE, which SQLite does not run on an index by default
+        criteria = [Abbreviation.abbr >= search_query, Abbreviation.abbr < search_query + "\U0010ffff"]
+    return (
+        select(Abbreviation.abbr, Abbreviation.expan, Abbreviation.count)
+        .where(*criteria)
+        .order_by(Abbreviation.count.desc(), Abbreviation.abbr, Abbreviation.expan)
+        .limit(limit)
+    )
+
+
+def lookup_abbreviations(search_query, exact=False, limit=10):
+    exact = exact or len(search_query) < ABBREVIATION_MIN_PREFIX
+    return [row._asdict() for row in db.session.execute(abbreviations_query(search_query, exact, limit))]
+
+
+LINE_FIELDS = ("normalized", "merge", "status")  # Fields of a line editable through the API
+
+
+class EditConflict(Exception):
+    """ Raised when lines were changed by someone else since the version an edit is based on. `lines` holds
+    their current state.
+    """
+    def __init__(self, lines):
+        super().__init__(f"Lines {', '.join(str(line['id']) for line in lines)} were changed in the meantime")
+        self.lines = lines
+
+
+def line_states(*criteria):
+    """ Current state, as sent to the editor, of the lines matching criteria
+    """
+    return [
+        row._asdict() for row in db.session.execute(
+            select(Line.id, Line.normalized, Line.merge, Line.status, Line.version)
+            .where(*criteria)
+            .order_by(Line.start, Line.id)
+        )
+    ]
+
+
+def lines_changed_since(doc_id, revision):
+    """ Lines of a document written after its `revision`
+    """
+    return line_states(Line.doc_id == doc_id, Line.version > revision)
+
+
+ROLLUP_PERIODS = {
+    "hour": lambda moment: moment.replace(minute=0, second=0, microsecond=0),
+    "day": lambda moment: moment.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+
+ROLLUP_COLUMNS = ("edits", "validated", "excluded", "pending", "normalized")
 
-        if j.get("format", "passim") != "passim":
-            yield from import_prepared_doc(j)
+
+def record_line_edits(edits, user_id=None):
+    """ Append edits, (line id, doc id, old values, new values) with the values of LINE_FIELDS as mappings,
+    to the journal and add them to the hourly and daily rollups. Edits which change nothing are left out.
+    The caller commits, so that the journal is written in the transaction of the edits.
+    """
+    now = utcnow()
+    entries = []
+    rollups = collections.defaultdict(collections.Counter)
+    for line_id, doc_id, old, new in edits:
+        if all(old[field] == new[field] for field in LINE_FIELDS):
             continue
+        entries.append({
+            "line_id": line_id, "doc_id": doc_id, "user_id": user_id, "created_at": now,
+            **{f"old_{field}": old[field] for field in LINE_FIELDS},
+            **{f"new_{field}": new[field] for field in LINE_FIELDS},
+        })
+        deltas = rollups[doc_id]
+        deltas["edits"] += 1
+        if old["status"] != new["status"]:
+            deltas[status_counter(new["status"]).removesuffix("_count")] += 1
+        if old["normalized"] != new["normalized"]:
+            deltas["normalized"] += 1
+    if entries:
+        db.session.execute(insert(LineEdit.__table__), entries)
+        add_edit_rollups(rollups, user_id, now)
+    return len(entries)
+
+
+def record_doc_change(doc_id, user_id=None):
+    """ Append a journal entry without line for a change of the document outside of its lines' annotations,
+    a rename or a re-import, so that incremental exports pick it up. It is not counted in the rollups.
+    The caller commits.
+    """
+    db.session.execute(insert(LineEdit.__table__).values(line_id=0, doc_id=doc_id, user_id=user_id,
+                                                          created_at=utcnow()))
+
 
-        # Check if document already exists
-        existing_doc = Doc.query.filter_by(title=j["id"]).first()
-        if existing_doc:
-            yield f"Document with ID {j['id']} already exists. Skipping...", "warning", "bold"
-            continue  # Skip if it exists
+def add_edit_rollups(rollups, user_id, moment):
+    """ Add Counters of ROLLUP_COLUMNS deltas by document id to the hourly and daily rollups of `moment`
+    """
+    statement = upsert_insert(EditRollup)
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[EditRollup.period, EditRollup.start, EditRollup.user_id, EditRollup.doc_id],
+            set_={
+                column: getattr(EditRollup, column) + getattr(statement.excluded, column)
+                for column in ROLLUP_COLUMNS
+            }
+        ),
+        [
+            {"period": period, "start": bucket(moment), "user_id": user_id or 0, "doc_id": doc_id,
+             **{column: deltas[column] for column in ROLLUP_COLUMNS}}
+            for period, bucket in ROLLUP_PERIODS.items()
+            for doc_id, deltas in rollups.items()
+        ]
+    )
+
+
+def journal_cursor():
+    """ Id of the last journal entry, the cursor to pass to changed_since() to get the later changes
+    """
+    return db.session.scalar(select(func.coalesce(func.max(LineEdit.id), 0)))
+
+
+def changed_since(cursor):
+    """ Criterion of the documents with lines edited, or renamed or re-imported, after the journal entry `cursor`
+    """
+    return Doc.id.in_(select(LineEdit.doc_id).where(LineEdit.id > cursor).distinct())
 
-        # Create and insert new document
-        new_doc = Doc(title=j["id"], text=j["text"])
-        db.session.add(new_doc)
-        db.session.commit()  # Save to get an ID
-        yield f"Document {j['id']} created successfully.", "success", "bold"
 
-        # Prepare for preprocessing
-        last_end = 0
-        line_id = 1  # Start ID from 1
+def throughput(period="day", by="user", since=None):
+    """ Edits per `period` (hour or day) and user or document (`by`) from the rollups, newest first
+    """
+    group = EditRollup.user_id if by == "user" else EditRollup.doc_id
+    criteria = [EditRollup.period == period]
+    if since is not None:
+        criteria.append(EditRollup.start >= ROLLUP_PERIODS[period](since))
+    rows = db.session.execute(
+        select(
+            EditRollup.start, group,
+            func.sum(EditRollup.edits), func.sum(EditRollup.validated), func.sum(EditRollup.excluded),
+            func.sum(EditRollup.pending), func.sum(EditRollup.normalized)
+        )
+        .where(*criteria)
+        .group_by(EditRollup.start, group)
+        .order_by(EditRollup.start.desc(), group)
+    ).all()
+    return [
+        {"start": start.isoformat(), by: key, "edits": edits, "validated": validated, "excluded": excluded,
+         "pending": pending, "normalized": normalized}
+        for start, key, edits, validated, excluded, pending, normalized in rows
+    ]
+
+
+def apply_line_updates(doc_id, updates, user_id=None):
+    """ Apply line updates, dicts with the line `id` and any of LINE_FIELDS, to the lines of a document
+    with a single executemany UPDATE, and bump the document revision and counters, update the
+    abbreviation index and journal the edits of `user_id`. The caller commits.
+
+    An update carrying the `version` of the line it is based on is only applied if the line is still at
+    this version. The version is checked again in the WHERE clause of the UPDATE, so that no row is
+    locked between reading the lines and writing them.
+
+    Returns the new status and version of each updated line by id. Raises LookupError if a line is not part
+    of the document and EditConflict if a line changed since the version of its update.
+    """
+    ids = {int(data["id"]) for data in updates}
+    rows = db.session.execute(
+        select(Line.id, Line.canonical, Line.normalized, Line.merge, Line.status, Line.version)
+        .where(Line.doc_id == doc_id, Line.id.in_(ids))
+    ).all()
+    old_values = {row.id: row._asdict() for row in rows}
+    missing = ids - old_values.keys()
+    if missing:
+        raise LookupError(f"Lines {', '.join(map(str, sorted(missing)))} not found in document {doc_id}")
+    conflicts = {
+        int(data["id"]) for data in updates
+        if data.get("version") is not None and int(data["version"]) != old_values[int(data["id"])]["version"]
+    }
+    if conflicts:
+        raise EditConflict(line_states(Line.id.in_(conflicts)))
+
+    # Later updates of the same line win, the way successive saves would
+    new_values = {line_id: dict(values) for line_id, values in old_values.items()}
+    for data in updates:
+        values = new_values[int(data["id"])]
+        for field in LINE_FIELDS:
+            values[field] = data.get(field, values[field])
+
+    touch_doc(doc_id, [
+        (old_values[line_id]["status"], values["status"]) for line_id, values in new_values.items()
+    ])
+    version = db.session.scalar(select(Doc.revision).where(Doc.id == doc_id))
+    table = Line.__table__
+    result = db.session.execute(
+        update(table)
+        .where(table.c.id == bindparam("line_id"), table.c.version == bindparam("old_version"))
+        .values(version=version, **{field: bindparam(f"new_{field}") for field in LINE_FIELDS}),
+        [
+            {"line_id": line_id, "old_version": old_values[line_id]["version"],
+             **{f"new_{field}": values[field] for field in LINE_FIELDS}}
+            for line_id, values in new_values.items()
+        ]
+    )
+    if result.rowcount != len(new_values):  # Written by another transaction since they were read
+        raise EditConflict([line for line in line_states(Line.id.in_(ids)) if line["version"] != version])
+    abbreviations = collections.Counter()
+    for line_id, values in new_values.items():
+        abbreviations.subtract(validated_pairs(old_values[line_id]))
+        abbreviations.update(validated_pairs(values))
+    update_abbreviations(abbreviations)
+    record_line_edits(
+        [(line_id, doc_id, old_values[line_id], values) for line_id, values in new_values.items()], user_id
+    )
+    return {line_id: {"status": values["status"], "version": version} for line_id, values in new_values.items()}
+
+
+def rebuild_doc_counters():
+    """ Recompute the line counters of every document from the Line table, returns the number of
+    documents with lines
+    """
+    pending = or_(Line.status.is_(None), func.lower(Line.status) == "pending")
+    validated = func.lower(Line.status) == "validated"
+    rows = db.session.execute(
+        select(
+            Line.doc_id,
+            func.count(Line.id),
+            func.sum(case((pending, 1), else_=0)),
+            func.sum(case((validated, 1), else_=0))
+        ).group_by(Line.doc_id)
+    ).all()
+    db.session.execute(update(Doc).values(lines_count=0, validated_count=0, excluded_count=0, pending_count=0))
+    if rows:
+        db.session.execute(update(Doc), [
+            {"id": doc_id, "lines_count": total, "pending_count": pending_lines,
+             "validated_count": validated_lines, "excluded_count": total - pending_lines - validated_lines}
+            for doc_id, total, pending_lines, validated_lines in rows
+        ])
+    db.session.commit()
+    return len(rows)
+
+
+def prepared_record(jdoc):
+    """ Convert a more prepared format into an import record
+    """
+    rows = []
+    start = 0
+    for line in jdoc["lines"]:
+        rows.append((start, line["abbr"], line["expan"], line["merge"], False))
+        start += len(line["abbr"]+"\n")
+    return {"title": jdoc["title"], "human_readable": jdoc["human_readable"], "text": jdoc["text"], "rows": rows}
 
-        sorted_lines = sorted(j["lines"], key=lambda l: l["begin"])  # Sort by start index
 
-        for line_data in sorted_lines:
-            if not line_data.get("wits"):
+def passim_record(j):
+    """ Convert a passim alignment into an import record, adding the text not covered by passim as lines
+    """
+    rows = []
+    last_end = 0
+    sorted_lines = sorted(j["lines"], key=lambda l: l["begin"])  # Sort by start index
+
+    for line_data in sorted_lines:
+        if not line_data.get("wits"):
+            continue
+
+        start = line_data["begin"]
+        canonical = line_data["text"]
+
+        # Handle uncovered text before this line
+        if start > last_end:
+            uncovered_text = j["text"][last_end:start].strip()
+            if uncovered_text:
+                rows.append((last_end, uncovered_text, "", False, True))
+
+        # Add actual mapped line
+        rows.append((start, canonical, line_data["wits"][0]["text"], False, False))
+        last_end = start + len(canonical)  # Update last_end
+
+    # Handle remaining text at the end
+    if last_end < len(j["text"]) and j["text"][last_end:].strip():
+        rows.append((last_end, j["text"][last_end:], "", False, True))
+
+    return {"title": j["id"], "human_readable": None, "text": j["text"], "rows": rows}
+
+
+def parse_record(raw):
+    """ Parse a JSONL record into a dict with title, human_readable, text and rows, where rows are
+    (start, canonical, normalized, merge, uncovered) tuples
+    """
+    j = json.loads(raw)
+    if j.get("format", "passim") != "passim":
+        return prepared_record(j)
+    return passim_record(j)
+
+
+def record_hashes(record):
+    """ SHA-256 of the text of a record and of the (start, canonical) of its rows
+    """
+    text_hash = hashlib.sha256(record["text"].encode("utf-8")).hexdigest()
+    lines = json.dumps([[row[0], row[1]] for row in record["rows"]], ensure_ascii=False)
+    return text_hash, hashlib.sha256(lines.encode("utf-8")).hexdigest()
+
+
+def upsert_doc(stored, record, text_hash, lines_hash):
+    """ Diff a record against the stored document with the same title, matching lines by (start, canonical):
+    the stored lines without a match are deleted, the matched ones keep their status, normalized form and
+    merge flag. Titles are kept.
+
+    Returns the rows of the record to insert, the number of deleted lines and the new revision of the
+    document, or None when the document did not change.
+    """
+    unmatched = collections.defaultdict(list)
+    for line in db.session.execute(
+        select(Line.id, Line.start, Line.canonical, Line.normalized, Line.status).where(Line.doc_id == stored.id)
+    ):
+        unmatched[(line.start, line.canonical)].append(line)
+    new_rows = []
+    for row in record["rows"]:
+        matches = unmatched.get((row[0], row[1]))
+        if matches:
+            matches.pop()
+        else:
+            new_rows.append(row)
+    removed = [line for matches in unmatched.values() for line in matches]
+
+    values = {"text_hash": text_hash, "lines_hash": lines_hash}
+    if stored.text_hash is None:  # Imported before the hashes were stored
+        text_changed = db.session.scalar(select(Doc.text).where(Doc.id == stored.id)) != record["text"]
+    else:
+        text_changed = stored.text_hash != text_hash
+    if text_changed:
+        values["text"] = record["text"]
+
+    if not (new_rows or removed or text_changed):
+        db.session.execute(update(Doc).where(Doc.id == stored.id).values(**values))
+        return None
+    if removed:
+        db.session.execute(delete(Line).where(Line.id.in_([line.id for line in removed])))
+        removed_pairs = collections.Counter()
+        for line in removed:
+            removed_pairs.subtract(validated_pairs(line._mapping))
+        update_abbreviations(removed_pairs)
+    touch_doc(stored.id, added=["Pending"] * len(new_rows), removed=[line.status for line in removed], **values)
+    record_doc_change(stored.id)
+    return new_rows, len(removed), db.session.scalar(select(Doc.revision).where(Doc.id == stored.id))
+
+
+def import_records(records, batch_size=None, commit_every=None, stats=None, verbose=True, upsert=False):
+    """ Insert parsed records, skipping titles already in the database, or with `upsert` updating the
+    documents whose content hashes changed with upsert_doc().
+
+    Lines are sent in executemany batches of `batch_size` and the transaction is committed every
+    `commit_every` documents. Without `verbose`, no message is yielded for lines imported as is.
+    """
+    batch_size = batch_size or current_app.config.get("IMPORT_BATCH_SIZE", IMPORT_BATCH_SIZE)
+    commit_every = commit_every or current_app.config.get("IMPORT_COMMIT_EVERY", IMPORT_COMMIT_EVERY)
+    stats = stats if stats is not None else ImportStats()
+
+    known_titles = set(db.session.scalars(select(Doc.title)))
+    stored_docs = {}
+    if upsert:
+        stored_docs = {
+            row.title: row for row in db.session.execute(select(Doc.id, Doc.title, Doc.text_hash, Doc.lines_hash))
+        }
+    pending_lines = []
+    pending_docs = 0
+
+    def flush():
+        if pending_lines:
+            db.session.execute(insert(Line), pending_lines)
+            pending_lines.clear()
+
+    def add_lines(doc_id, rows, version=1):
+        for start, canonical, normalized, merge, uncovered in rows:
+            pending_lines.append({
+                "start": start, "canonical": canonical, "normalized": normalized, "merge": merge,
+                "status": "Pending", "doc_id": doc_id, "version": version
+            })
+            stats.lines += 1
+            if uncovered:
+                stats.uncovered += 1
+                yield f"Uncovered line added at position {start} for `{canonical}`", "warning", ""
+            elif verbose:
+                yield f"Line added: {canonical}", "info", ""
+            if len(pending_lines) >= batch_size:
+                flush()
+
+    try:
+        for record in records:
+            title = record["title"]
+            text_hash, lines_hash = record_hashes(record)
+
+            if title in stored_docs:
+                # Popped so that a title repeated in the input is skipped as usual
+                stored = stored_docs.pop(title)
+                if (stored.text_hash, stored.lines_hash) == (text_hash, lines_hash):
+                    stats.unchanged += 1
+                    yield f"Document {title} unchanged.", "info", ""
+                    continue
+                changes = upsert_doc(stored, record, text_hash, lines_hash)
+                if changes is None:
+                    stats.unchanged += 1
+                    yield f"Document {title} unchanged.", "info", ""
+                else:
+                    new_rows, removed, revision = changes
+                    stats.updated += 1
+                    yield (f"Document {title} updated: {len(new_rows)} lines added, {removed} removed.",
+                           "success", "bold")
+                    yield from add_lines(stored.id, new_rows, version=revision)
+            elif title in known_titles:
+                stats.skipped += 1
+                yield f"Document with ID {title} already exists. Skipping...", "warning", "bold"
                 continue
+            else:
+                known_titles.add(title)
+                doc_id = db.session.execute(
+                    insert(Doc).values(title=title, human_readable=record["human_readable"], text=record["text"],
+                                       lines_count=len(record["rows"]), pending_count=len(record["rows"]),
+                                       updated_at=utcnow(), text_hash=text_hash, lines_hash=lines_hash)
+                ).inserted_primary_key[0]
+                stats.documents += 1
+                yield f"Document {title} created successfully.", "success", "bold"
+                yield from add_lines(doc_id, record["rows"])
+
+            pending_docs += 1
+            if pending_docs >= commit_every:
+                flush()
+                db.session.commit()
+                stats.checkpoint()
+                pending_docs = 0
+            yield f"Document {title} import completed.", "success", ""
+
+        flush()
+        db.session.commit()
+        stats.checkpoint()
+    except Exception as E:
+        db.session.rollback()
+        raise E
 
-            start = line_data["begin"]
-            canonical = line_data["text"]
-            normalized = line_data["wits"][0]["text"]
-
-            # Handle uncovered text before this line
-            if start > last_end:
-                uncovered_text = j["text"][last_end:start].strip()
-                if uncovered_text:
-                    uncovered_line = Line(
-                        start=last_end, canonical=uncovered_text, normalized="", doc_id=new_doc.id
-                    )
-                    db.session.add(uncovered_line)
-                    line_id += 1
-                    yield f"Uncovered line added at position {last_end} for `{uncovered_text}`", "warning", ""
-
-            # Add actual mapped line
-            new_line = Line(start=start, canonical=canonical, normalized=normalized, doc_id=new_doc.id)
-            db.session.add(new_line)
-            last_end = start + len(canonical)  # Update last_end
-            yield f"Line added: {canonical}", "info", ""
-
-        # Handle remaining text at the end
-        if last_end < len(j["text"]) and j["text"][last_end:].strip():
-            trailing_line = Line(
-                start=last_end, canonical=j["text"][last_end:], normalized="", doc_id=new_doc.id
-            )
-            db.session.add(trailing_line)
-            yield f"Uncovered line added at position {last_end} for `{uncovered_text}`", "warning", ""
-
-        db.session.commit()  # Save all lines
-        yield f"Document {j['id']} import completed.", "success", ""
+    yield stats.summary(), "success", "bold"
+
+
+def import_prepared_doc(jdoc, **kwargs):
+    """ Import a more prepared format
+    """
+    yield from import_records([prepared_record(jdoc)], **kwargs)
+
+
+def parse_records(file_stream, workers=1):
+    """ Parse the non-empty lines of a JSONL stream, in order. With more than one worker, parsing is done
+    by a process pool while the caller writes the previous records to the database.
+    """
+    lines = (line for line in file_stream if line.strip())
+    if workers <= 1:
+        yield from map(parse_record, lines)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        # Keep a bounded number of records in flight so that huge files are not read in memory at once
+        in_flight = collections.deque()
+        for line in lines:
+            in_flight.append(pool.apply_async(parse_record, (line,)))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+
+
+def import_jsonl_stream(file_stream, workers=1, **kwargs):
+    """ Import a JSONL stream of passim or prepared documents
+    """
+    yield from import_records(parse_records(file_stream, workers=workers), **kwargs)
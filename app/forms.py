@@ -1,8 +1,9 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired
-from wtforms import SubmitField
+from wtforms import BooleanField, SubmitField
 
 
 class UploadForm(FlaskForm):
     file = FileField("JSONL File", validators=[FileRequired()])
+    upsert = BooleanField("Update existing documents")
     submit = SubmitField('Submit')
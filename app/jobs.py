@@ -0,0 +1,205 @@
+""" Background import jobs: uploads are spooled to disk, recorded as ImportJob rows and imported by a local
+thread pool, so that no request is held open while a large file is imported.
+
+The status and counters of a job are stored in the database, where the import page polls them. Progress is
+written every IMPORT_PROGRESS_INTERVAL seconds and becomes visible when the import commits its current
+batch of documents. Cancelling a job drops a marker file next to the spooled upload, which the worker looks
+for at the same pace: a database flag would wait behind the write lock the import holds. Documents already
+committed are kept.
+
+A job records the process whose pool it was queued in. Jobs whose process is gone, e.g. restarted while they
+were queued or running, are marked as Failed by fail_orphaned_jobs() when jobs are listed or polled.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select, update
+from werkzeug.utils import secure_filename
+
+from .db import db, ImportJob, ImportStats, import_jsonl_stream, utcnow
+
+_executor = None
+_executor_lock = threading.Lock()
+_live_jobs = set()  # Ids of the jobs queued in the pool of this process and not over yet
+
+
+def _reset_executor():
+    global _executor, _executor_lock, _live_jobs
+    _executor = None
+    _executor_lock = threading.Lock()
+    _live_jobs = set()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_executor)  # The threads of the pool do not survive a fork
+
+
+class ImportCancelled(Exception):
+    """ Raised in the worker when the cancellation of its job was requested
+    """
+
+
+def spool_directory(app):
+    directory = app.config.get("IMPORT_SPOOL_DIR") or os.path.join(app.instance_path, "imports")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def executor(app):
+    """ Thread pool of the process, created on first use
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config.get("IMPORT_JOB_WORKERS", 1),
+                                           thread_name_prefix="import-job")
+        return _executor
+
+
+def enqueue_upload(app, file, user_id=None, upsert=False):
+    """ Spool an uploaded file to disk, record its job and queue it, returns the job
+    """
+    filename = secure_filename(file.filename or "") or "upload.jsonl"
+    path = os.path.join(spool_directory(app), f"{uuid.uuid4().hex}-{filename}")
+    file.save(path)
+
+    job = ImportJob(filename=filename, path=path, user_id=user_id, upsert=upsert, worker=worker_name())
+    db.session.add(job)
+    db.session.flush()
+    _live_jobs.add(job.id)  # Before the job is visible, so that it is never taken for an orphan
+    db.session.commit()
+    executor(app).submit(run_import_job, app, job.id)
+    return job
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _worker_alive(job):
+    """ Whether the process which queued a job still runs. Only processes of this host can be checked, the
+    spool directory being local the others are assumed to be alive.
+    """
+    if job.worker is None:  # Queued before the worker was recorded
+        return False
+    host, _, pid = job.worker.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return job.id in _live_jobs
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Alive, run by another user
+        return True
+    return True
+
+
+def fail_orphaned_jobs():
+    """ Mark the queued or running jobs whose process is gone as Failed and remove their spooled files,
+    returns their number
+    """
+    orphaned = [
+        job for job in db.session.scalars(select(ImportJob).where(ImportJob.status.in_(("Queued", "Running"))))
+        if not _worker_alive(job)
+    ]
+    for job in orphaned:
+        job.status = "Failed"
+        job.message = "Interrupted by a restart of the server, committed documents are kept. Upload the file again."
+        job.updated_at = utcnow()
+        _remove_spooled(job.path, cancel_marker(job))
+    if orphaned:
+        db.session.commit()
+    return len(orphaned)
+
+
+def _remove_spooled(*paths):
+    for spooled in paths:
+        if os.path.exists(spooled):
+            os.remove(spooled)
+
+
+def cancel_marker(job):
+    return f"{job.path}.cancel"
+
+
+def request_cancel(job):
+    """ Ask the worker to stop a job, it is cancelled before its next progress update or before it starts
+    """
+    if not job.finished:
+        open(cancel_marker(job), "w").close()
+
+
+def job_json(job):
+    """ ImportJob.json() including the cancellations the worker did not acknowledge yet
+    """
+    data = job.json()
+    data["cancel_requested"] = job.cancel_requested or (not job.finished and os.path.exists(cancel_marker(job)))
+    return data
+
+
+def _record_progress(job_id, stats, **values):
+    db.session.execute(
+        update(ImportJob).where(ImportJob.id == job_id).values(
+            documents=stats.documents, lines=stats.lines, uncovered=stats.uncovered, skipped=stats.skipped,
+            updated=stats.updated, unchanged=stats.unchanged, updated_at=utcnow(), **values
+        )
+    )
+
+
+def run_import_job(app, job_id):
+    """ Import the spooled file of a job, in its own app context
+    """
+    with app.app_context():
+        try:
+            _import_job(app, job_id)
+        finally:
+            _live_jobs.discard(job_id)
+
+
+def _import_job(app, job_id):
+    job = db.session.get(ImportJob, job_id)
+    if job is None or job.status != "Queued":
+        return
+    path, marker, upsert = job.path, cancel_marker(job), job.upsert
+    interval = app.config.get("IMPORT_PROGRESS_INTERVAL", 1.0)
+    stats = ImportStats()
+    last_progress = time.monotonic()
+    try:
+        if os.path.exists(marker):
+            raise ImportCancelled()
+        job.status = "Running"
+        job.updated_at = utcnow()
+        db.session.commit()
+        with open(path) as f:
+            importer = import_jsonl_stream(f, stats=stats, verbose=False, upsert=upsert)
+            try:
+                for message, cls, details in importer:
+                    if time.monotonic() - last_progress < interval:
+                        continue
+                    if os.path.exists(marker):
+                        raise ImportCancelled()
+                    _record_progress(job_id, stats)
+                    last_progress = time.monotonic()
+            finally:
+                importer.close()
+        _record_progress(job_id, stats, status="Completed", message=stats.summary())
+    except ImportCancelled:
+        # Drop the documents of the transaction in progress, the committed ones stay
+        db.session.rollback()
+        stats.restore()
+        _record_progress(job_id, stats, status="Cancelled", cancel_requested=True,
+                         message=f"Cancelled after {stats.documents} documents, committed documents are kept.")
+    except Exception as E:
+        db.session.rollback()
+        stats.restore()
+        app.logger.exception("Import job %s failed", job_id)
+        _record_progress(job_id, stats, status="Failed", message=f"{type(E).__name__}: {E}")
+    finally:
+        db.session.commit()
+        _remove_spooled(path, marker)
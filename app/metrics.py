@@ -0,0 +1,146 @@
+""" Optional per-endpoint instrumentation: number of SQL queries, SQL time and latency of each request,
+a slow query log, and histograms of them in the Prometheus text format at /metrics (admins only).
+
+Enabled by the METRICS_ENABLED configuration key. When it is off, no hook is registered at all. Histograms
+are kept per process.
+"""
+import logging
+import threading
+import time
+
+from flask import Blueprint, Response, g, request, has_request_context, abort
+from flask_login import login_required, current_user
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+slow_query_log = logging.getLogger("app.metrics.slow_queries")
+
+bp_metrics = Blueprint("bp_metrics", __name__)
+
+
+class Histogram:
+    """ Cumulative Prometheus histogram
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """ Histograms and counters by (metric, endpoint)
+    """
+    METRICS = {
+        "paramhtrs_request_duration_seconds": ("Request latency", LATENCY_BUCKETS),
+        "paramhtrs_request_queries": ("SQL queries per request", QUERY_BUCKETS),
+        "paramhtrs_request_sql_duration_seconds": ("SQL time per request", LATENCY_BUCKETS),
+    }
+    SLOW_QUERIES = "paramhtrs_slow_queries_total"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.slow_queries = {}
+
+    def observe(self, metric, endpoint, value):
+        with self.lock:
+            if (metric, endpoint) not in self.histograms:
+                self.histograms[(metric, endpoint)] = Histogram(self.METRICS[metric][1])
+            self.histograms[(metric, endpoint)].observe(value)
+
+    def count_slow_query(self, endpoint):
+        with self.lock:
+            self.slow_queries[endpoint] = self.slow_queries.get(endpoint, 0) + 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for metric, (description, _) in self.METRICS.items():
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} histogram")
+                for (name, endpoint), histogram in sorted(self.histograms.items()):
+                    if name != metric:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{metric}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                    lines.append(f'{metric}_bucket{{endpoint="{endpoint}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{metric}_sum{{endpoint="{endpoint}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{endpoint="{endpoint}"}} {histogram.count}')
+            lines.append(f"# HELP {self.SLOW_QUERIES} Queries slower than METRICS_SLOW_QUERY_MS")
+            lines.append(f"# TYPE {self.SLOW_QUERIES} counter")
+            for endpoint, count in sorted(self.slow_queries.items()):
+                lines.append(f'{self.SLOW_QUERIES}{{endpoint="{endpoint}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def _endpoint():
+    return (request.endpoint or "unmatched") if has_request_context() else "none"
+
+
+def init_metrics(app, engine):
+    """ Hook the engine and the app if METRICS_ENABLED is set
+    """
+    if not app.config.get("METRICS_ENABLED"):
+        return
+    slow_query_seconds = app.config.get("METRICS_SLOW_QUERY_MS", 200) / 1000
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        if has_request_context() and "metrics_started" in g:
+            g.metrics_queries += 1
+            g.metrics_sql_time += elapsed
+        if elapsed >= slow_query_seconds:
+            endpoint = _endpoint()
+            registry.count_slow_query(endpoint)
+            slow_query_log.warning("%.1f ms in %s: %s", elapsed * 1000, endpoint, statement)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement gets no after_cursor_execute, drop its start time from the pooled connection
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if context.execution_context is not None and started:
+            started.pop()
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_sql_time = 0.0
+
+    @app.teardown_request
+    def record_request_metrics(exception=None):
+        # Streamed responses are torn down once their last chunk is sent
+        if "metrics_started" not in g:
+            return
+        endpoint = _endpoint()
+        registry.observe("paramhtrs_request_duration_seconds", endpoint, time.perf_counter() - g.metrics_started)
+        registry.observe("paramhtrs_request_queries", endpoint, g.metrics_queries)
+        registry.observe("paramhtrs_request_sql_duration_seconds", endpoint, g.metrics_sql_time)
+
+    app.register_blueprint(bp_metrics)
+
+
+@bp_metrics.route("/metrics")
+@login_required
+def metrics_route():
+    if not current_user.is_admin:
+        abort(403)
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,123 @@
+""" Upgrade of existing databases to the current models, and query plans of the hot queries.
+"""
+from sqlalchemy import inspect, select, func, text, and_, tuple_
+from sqlalchemy.schema import CreateColumn
+
+from .db import (db, Doc, Line, DocExport, EditRollup, rebuild_doc_counters, rebuild_abbreviations,
+                 abbreviations_query, changed_since)
+
+COUNTER_COLUMNS = {"doc.lines_count", "doc.validated_count", "doc.excluded_count", "doc.pending_count"}
+
+
+def add_missing_columns():
+    """ Add to existing tables the columns the models gained since the database was created, returns
+    their names
+    """
+    inspector = inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+                added.append(f"{table.name}.{column.name}")
+    db.session.commit()
+    return added
+
+
+def existing_indexes(inspector, table_name):
+    """ Names of the indexes of a table, including SQLite expression indexes which are not reflected
+    """
+    if db.engine.dialect.name == "sqlite":
+        return set(db.session.scalars(
+            text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+            {"table": table_name}
+        ))
+    return {index["name"] for index in inspector.get_indexes(table_name)}
+
+
+def upgrade_schema():
+    """ Create missing tables, columns and indexes without touching existing data, returns the list of
+    changes made
+    """
+    changes = []
+    tables = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    changes.extend(f"Added table {name}" for name in db.metadata.tables if name not in tables)
+    if "abbreviation" not in tables:
+        rebuild_abbreviations()
+        changes.append("Built abbreviation index")
+
+    added = add_missing_columns()
+    changes.extend(f"Added column {name}" for name in added)
+    if COUNTER_COLUMNS & set(added):
+        rebuild_doc_counters()
+        changes.append("Rebuilt document counters")
+
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = existing_indexes(inspector, table.name)
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                changes.append(f"Added index {index.name}")
+
+    if db.engine.dialect.name == "sqlite":
+        # Refresh the statistics the query planner uses to pick indexes
+        db.session.execute(text("ANALYZE"))
+        db.session.commit()
+    return changes
+
+
+def hot_queries():
+    """ The queries run by the most used pages, with representative parameters
+    """
+    doc_id = db.session.scalar(select(func.min(Doc.id))) or 1
+    return {
+        "document list": (
+            select(Doc.id).where(Doc.pending_count > 0)
+            .order_by(func.lower(Doc.human_readable), func.lower(Doc.title)).limit(20)
+        ),
+        "document lines": select(Line.id).where(Line.doc_id == doc_id).order_by(Line.start, Line.id),
+        "lines page": (
+            select(Line.id).where(Line.doc_id == doc_id, tuple_(Line.start, Line.id) > tuple_(100, 0))
+            .order_by(Line.start, Line.id).limit(100)
+        ),
+        "line updates": select(Line.id, Line.status).where(Line.doc_id == doc_id, Line.id.in_([1, 2, 3])),
+        "pending lines of a document": select(func.count(Line.id)).where(
+            Line.doc_id == doc_id, Line.status == "Pending"
+        ),
+        "lines changed since a revision": (
+            select(Line.id).where(Line.doc_id == doc_id, Line.version > 10).order_by(Line.start, Line.id)
+        ),
+        "abbreviation prefix lookup": abbreviations_query("dn"),
+        "abbreviation exact lookup": abbreviations_query("dñs", exact=True),
+        "corpus download": (
+            select(Doc.id, DocExport.payload)
+            .outerjoin(DocExport, and_(DocExport.doc_id == Doc.id, DocExport.revision == Doc.revision))
+            .where(Doc.id > 0, Doc.lines_count > 0, Doc.pending_count == 0)
+            .order_by(Doc.id).limit(100)
+        ),
+        "incremental download": (
+            select(Doc.id).where(Doc.id > 0, Doc.lines_count > 0, changed_since(1000)).order_by(Doc.id).limit(100)
+        ),
+        "daily throughput": (
+            select(EditRollup.start, EditRollup.user_id, func.sum(EditRollup.edits))
+            .where(EditRollup.period == "day", EditRollup.start >= "2024-01-01")
+            .group_by(EditRollup.start, EditRollup.user_id)
+        ),
+    }
+
+
+def explain_queries():
+    """ Yield (name, SQL, plan details, full scans) for every hot query, using SQLite's EXPLAIN QUERY PLAN.
+    A full scan is a SCAN step which does not go through an index.
+    """
+    for name, statement in hot_queries().items():
+        sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+        plan = [row[-1] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+        scans = [step for step in plan if step.startswith("SCAN") and "INDEX" not in step]
+        yield name, sql, plan, scans
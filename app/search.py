@@ -0,0 +1,132 @@
+""" Full-text search over document titles and line contents, backed by SQLite FTS5.
+
+The indexes are external content tables kept in sync with `doc` and `line` by triggers, so that imports
+and line edits update them in the same transaction.
+"""
+from sqlalchemy import select, text, literal_column, or_
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import table, column
+
+from .db import db, Doc, Line
+
+TOKENIZER = "unicode61 remove_diacritics 0"  # Keep combining marks such as the tilde of q̃
+
+FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS doc_fts USING fts5(
+        title, human_readable, content='doc', content_rowid='id', tokenize='{TOKENIZER}')""",
+    """CREATE TRIGGER IF NOT EXISTS doc_fts_insert AFTER INSERT ON doc BEGIN
+        INSERT INTO doc_fts(rowid, title, human_readable) VALUES (new.id, new.title, new.human_readable);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS doc_fts_delete AFTER DELETE ON doc BEGIN
+        INSERT INTO doc_fts(doc_fts, rowid, title, human_readable)
+        VALUES ('delete', old.id, old.title, old.human_readable);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS doc_fts_update AFTER UPDATE OF title, human_readable ON doc BEGIN
+        INSERT INTO doc_fts(doc_fts, rowid, title, human_readable)
+        VALUES ('delete', old.id, old.title, old.human_readable);
+        INSERT INTO doc_fts(rowid, title, human_readable) VALUES (new.id, new.title, new.human_readable);
+    END""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS line_fts USING fts5(
+        canonical, normalized, content='line', content_rowid='id', tokenize='{TOKENIZER}')""",
+    """CREATE TRIGGER IF NOT EXISTS line_fts_insert AFTER INSERT ON line BEGIN
+        INSERT INTO line_fts(rowid, canonical, normalized) VALUES (new.id, new.canonical, new.normalized);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS line_fts_delete AFTER DELETE ON line BEGIN
+        INSERT INTO line_fts(line_fts, rowid, canonical, normalized)
+        VALUES ('delete', old.id, old.canonical, old.normalized);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS line_fts_update AFTER UPDATE OF canonical, normalized ON line BEGIN
+        INSERT INTO line_fts(line_fts, rowid, canonical, normalized)
+        VALUES ('delete', old.id, old.canonical, old.normalized);
+        INSERT INTO line_fts(rowid, canonical, normalized) VALUES (new.id, new.canonical, new.normalized);
+    END""",
+]
+
+doc_fts = table("doc_fts", column("rowid"))
+line_fts = table("line_fts", column("rowid"))
+
+_ready_engines = set()
+
+
+def is_supported():
+    return db.engine.dialect.name == "sqlite"
+
+
+def index_ready():
+    """ Check that the FTS tables exist. Only positive answers are cached, so that an index built by
+    another process is picked up.
+    """
+    if not is_supported():
+        return False
+    if db.engine.url in _ready_engines:
+        return True
+    found = db.session.scalar(
+        text("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN ('doc_fts', 'line_fts')")
+    )
+    if found == 2:
+        _ready_engines.add(db.engine.url)
+        return True
+    return False
+
+
+def create_index():
+    """ Create the FTS tables and their triggers if they do not exist
+    """
+    for statement in FTS_DDL:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+def drop_index():
+    """ Drop the FTS tables, their triggers go with the indexed tables
+    """
+    db.session.execute(text("DROP TABLE IF EXISTS doc_fts"))
+    db.session.execute(text("DROP TABLE IF EXISTS line_fts"))
+    db.session.commit()
+    _ready_engines.discard(db.engine.url)
+
+
+def rebuild_index():
+    """ Create the FTS tables if needed and rebuild them from the content of `doc` and `line`
+    """
+    create_index()
+    db.session.execute(text("INSERT INTO doc_fts(doc_fts) VALUES ('rebuild')"))
+    db.session.execute(text("INSERT INTO line_fts(line_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+
+def fts_query(search_query):
+    """ Turn user input into an FTS5 query: every whitespace separated term is quoted and matched as a
+    prefix, terms are AND-ed.
+    """
+    terms = []
+    for term in search_query.split():
+        terms.append('"' + term.replace('"', '""') + '"*')
+    return " ".join(terms)
+
+
+def filter_documents(query, search_query):
+    """ Restrict a Doc query to the documents whose title or human readable title match
+    """
+    if not search_query:
+        return query
+    if index_ready():
+        matching = select(doc_fts.c.rowid).where(literal_column("doc_fts").op("MATCH")(fts_query(search_query)))
+        return query.filter(Doc.id.in_(matching))
+    return query.filter(or_(
+        Doc.title.ilike(f'%{search_query}%'),
+        Doc.human_readable.ilike(f"%{search_query}%")
+    ))
+
+
+def search_lines(search_query, page=1, per_page=50):
+    """ Paginate the lines whose canonical or normalized form match, best bm25 rank first
+    """
+    statement = (
+        select(Line)
+        .join(line_fts, line_fts.c.rowid == Line.id)
+        .where(literal_column("line_fts").op("MATCH")(fts_query(search_query)))
+        .order_by(text("bm25(line_fts)"), Line.id)
+        .options(joinedload(Line.doc).load_only(Doc.title, Doc.human_readable))
+    )
+    return db.paginate(statement, page=page, per_page=per_page, error_out=False)
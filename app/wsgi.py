@@ -0,0 +1,8 @@
+""" Entry point of WSGI servers. The application is fully initialised at import, so that a server preloading
+it shares it between its workers, each disposing of the inherited database connections after the fork:
+
+    gunicorn --workers 4 --preload app.wsgi:app
+"""
+from . import create_app
+
+app = create_app(web=True)
@@ -0,0 +1,2 @@
+""" Benchmarks of the application, run from the repository root with `python -m benchmarks.<name>`.
+"""
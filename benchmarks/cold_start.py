@@ -0,0 +1,79 @@
+""" Cold start of the CLI and of the server, each run in a fresh interpreter.
+
+    python -m benchmarks.cold_start --runs 10
+
+`cli` builds the app the way `flask` commands do and runs a query, `cli (eager web)` also initialises the web
+part as every command did before the application factory, `server` imports app.wsgi and serves a first
+request. `flask db explain` is timed as a whole process, interpreter start included.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from .common import temporary_app
+
+SCENARIOS = {
+    "cli": (
+        "from app import create_app\n"
+        "from app.db import db\n"
+        "app = create_app()\n"
+        "with app.app_context():\n"
+        "    db.session.execute(db.select(1))\n"
+    ),
+    "cli (eager web)": (
+        "from app import create_app\n"
+        "from app.db import db\n"
+        "app = create_app(web=True)\n"
+        "with app.app_context():\n"
+        "    db.session.execute(db.select(1))\n"
+    ),
+    "server": (
+        "from app.wsgi import app\n"
+        "assert app.test_client().get('/login').status_code == 200\n"
+    ),
+}
+TIMER = "import time\nstarted = time.perf_counter()\n{code}print((time.perf_counter() - started) * 1000)\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters per scenario")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    app = temporary_app()
+    env = dict(os.environ, PARAMHTRS_SQLALCHEMY_DATABASE_URI=app.config["SQLALCHEMY_DATABASE_URI"])
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.getcwd(), env.get("PYTHONPATH")]))
+
+    report = {}
+    for name, code in SCENARIOS.items():
+        timings = [
+            float(subprocess.run([sys.executable, "-c", TIMER.format(code=code)], env=env, check=True,
+                                 capture_output=True, text=True).stdout)
+            for _ in range(args.runs)
+        ]
+        report[name] = {"runs": args.runs, "median_ms": round(statistics.median(timings), 1),
+                        "min_ms": round(min(timings), 1)}
+
+    timings = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "flask", "--app", "app", "db", "explain"], env=env, check=True,
+                       capture_output=True)
+        timings.append((time.perf_counter() - started) * 1000)
+    report["flask db explain (process)"] = {"runs": args.runs, "median_ms": round(statistics.median(timings), 1),
+                                            "min_ms": round(min(timings), 1)}
+
+    for name, result in report.items():
+        print(f"{name:<28} {result['median_ms']:>8.1f} ms median, {result['min_ms']:.1f} ms min")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
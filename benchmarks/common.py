@@ -0,0 +1,38 @@
+""" Helpers shared by the benchmarks: an application bound to a temporary SQLite database.
+"""
+import os
+import tempfile
+
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench"
+
+
+def temporary_app(**config):
+    """ Return the application on a fresh database in a temporary directory, with an approved admin
+    """
+    directory = tempfile.mkdtemp(prefix="paramhtrs-bench-")
+
+    from app import create_app
+    from app.db import db, User
+    from app import search
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(directory, "bench.db"),
+        "WTF_CSRF_ENABLED": False,
+        **config
+    }, web=True)
+    with app.app_context():
+        db.create_all()
+        search.create_index()
+        user = User(username=BENCH_USER, is_admin=True, is_approved=True)
+        user.set_password(BENCH_PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+    app.bench_directory = directory
+    return app
+
+
+def logged_in_client(app):
+    client = app.test_client()
+    client.post("/login", data={"username": BENCH_USER, "password": BENCH_PASSWORD})
+    return client
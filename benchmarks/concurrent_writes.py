@@ -0,0 +1,80 @@
+""" Throughput of N simultaneous line_route writers against a temporary SQLite database.
+
+    python -m benchmarks.concurrent_writes --writers 8 --requests 200
+
+Each writer is a thread with its own logged-in test client. Run it with PARAMHTRS_SQLITE_PRAGMAS='{}' to
+compare with SQLite's default journal and locking settings.
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+
+from .common import temporary_app, logged_in_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8, help="Simultaneous writers")
+    parser.add_argument("--requests", type=int, default=200, help="Line updates sent by each writer")
+    parser.add_argument("--source", default="source/n10.jsonl", help="JSONL file imported before the run")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    app = temporary_app()
+    from app.db import db, Line, import_jsonl_stream
+
+    with app.app_context():
+        with open(args.source) as f:
+            for _ in import_jsonl_stream(f):
+                pass
+        lines = db.session.execute(db.select(Line.doc_id, Line.id)).all()
+
+    results = []
+    results_lock = threading.Lock()
+
+    def writer(index):
+        client = logged_in_client(app)
+        rnd = random.Random(index)
+        local = []
+        for _ in range(args.requests):
+            doc_id, line_id = rnd.choice(lines)
+            status = rnd.choice(["Validated", "Excluded", "Pending"])
+            started = time.perf_counter()
+            response = client.post(f"/document/{doc_id}/line/{line_id}", json={"status": status})
+            local.append((response.status_code, time.perf_counter() - started))
+        with results_lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=writer, args=(index, )) for index in range(args.writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for _, latency in results)
+    report = {
+        "writers": args.writers,
+        "requests": len(results),
+        "errors": sum(1 for status, _ in results if status != 200),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(results) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(statistics.median(latencies), 2),
+            "p95": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+            "max": round(latencies[-1], 2),
+        },
+        "sqlite_pragmas": app.config["SQLITE_PRAGMAS"],
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+""" Synthetic corpus generator, writing passim or prepared JSONL at a configurable scale.
+
+    python -m benchmarks.generate corpus.jsonl --documents 1000 --lines 200 --line-length 60
+    python -m benchmarks.generate prepared.jsonl --format prepared
+"""
+import argparse
+import json
+import random
+
+# Abbreviated forms and their expansions, close to what the registers contain
+VOCABULARY = [
+    ("q̃", "que"), ("p̃positis", "prepositis"), ("d̃i", "dei"), ("omnibꝰ", "omnibus"), ("ẽ", "est"),
+    ("Rex", "rex"), ("dñs", "dominus"), ("ꝑ", "per"), ("⁊", "et"), ("gratia", "gracia"), ("sctõ", "sancto"),
+    ("mandam̃", "mandamus"), ("uobis", "vobis"), ("ecclĩa", "ecclesia"), ("anno", "anno"), ("dñi", "domini"),
+]
+
+
+def generate_line(rnd, line_length):
+    """ Return an (abbreviated, expanded) line of about line_length characters
+    """
+    abbr, expan = [], []
+    size = 0
+    while size < line_length:
+        short, full = rnd.choice(VOCABULARY)
+        abbr.append(short)
+        expan.append(full)
+        size += len(short) + 1
+    return " ".join(abbr), " ".join(expan)
+
+
+def generate_passim(index, lines, line_length, rnd):
+    """ A passim record: one alignment per line, with a few lines left uncovered
+    """
+    text = ""
+    aligned = []
+    for _ in range(lines):
+        abbr, expan = generate_line(rnd, line_length)
+        if rnd.random() > 0.05:
+            aligned.append({"begin": len(text), "text": abbr + "\n", "wits": [{"text": expan + "\n"}]})
+        text += abbr + "\n"
+    return {"id": f"synthetic/{index:07d}.xml", "text": text, "lines": aligned}
+
+
+def generate_prepared(index, lines, line_length, rnd):
+    """ A prepared record, with a few lines merged with the previous one
+    """
+    records = []
+    for line_index in range(lines):
+        abbr, expan = generate_line(rnd, line_length)
+        records.append({"abbr": abbr, "expan": expan, "merge": line_index > 0 and rnd.random() < 0.1})
+    return {
+        "format": "prepared",
+        "title": f"synthetic/{index:07d}.xml",
+        "human_readable": f"Synthetic register {index}",
+        "text": "".join(line["abbr"] + "\n" for line in records),
+        "lines": records
+    }
+
+
+def write_corpus(path, documents=100, lines=100, line_length=60, fmt="passim", seed=0):
+    """ Write a corpus of `documents` records to path, returns the number of lines written
+    """
+    rnd = random.Random(seed)
+    generate = generate_passim if fmt == "passim" else generate_prepared
+    with open(path, "w") as f:
+        for index in range(documents):
+            f.write(json.dumps(generate(index, lines, line_length, rnd), ensure_ascii=False) + "\n")
+    return documents * lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", help="JSONL file to write")
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=100, help="Lines per document")
+    parser.add_argument("--line-length", type=int, default=60, help="Characters per line")
+    parser.add_argument("--format", choices=["passim", "prepared"], default="passim")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    lines = write_corpus(args.output, args.documents, args.lines, args.line_length, args.format, args.seed)
+    print(f"{args.documents} documents and {lines} lines written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+""" Benchmarks of the core workflows on a synthetic corpus and a temporary database.
+
+    python -m benchmarks.run --documents 200 --lines 100 --output bench.json
+    python -m benchmarks.run --output new.json --compare bench.json
+
+Results are written as JSON with the commit they were measured at, so that runs of two commits can be
+compared with --compare.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+from .common import temporary_app, logged_in_client
+from .generate import write_corpus
+
+DOCUMENT_LIST_PAGE_SIZE = 20  # Documents per page of /document
+
+
+def timed(results, name, func, repeat=1):
+    """ Run func `repeat` times and store its timings under name
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    results[name] = {
+        "runs": repeat,
+        "total_s": round(sum(timings), 4),
+        "mean_ms": round(statistics.mean(timings) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+    }
+    print(f"{name:<28} {results[name]['mean_ms']:>10.2f} ms (min {results[name]['min_ms']:.2f} ms, {repeat} runs)")
+
+
+def get(client, url):
+    """ GET url and read the whole body, streamed or not
+    """
+    response = client.get(url)
+    response.get_data()
+    assert response.status_code == 200, f"{url} answered {response.status_code}"
+    return response
+
+
+def post(client, url, payload):
+    response = client.post(url, json=payload)
+    assert response.status_code == 200, f"{url} answered {response.status_code}"
+    return response
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous_path, report):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\nCompared with {previous.get('commit')} ({previous_path}):")
+    for name, result in report["results"].items():
+        before = previous["results"].get(name)
+        if before:
+            ratio = result["mean_ms"] / before["mean_ms"] if before["mean_ms"] else float("inf")
+            print(f"{name:<28} {before['mean_ms']:>10.2f} -> {result['mean_ms']:>10.2f} ms (x{ratio:.2f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=100, help="Lines per document")
+    parser.add_argument("--line-length", type=int, default=60, help="Characters per line")
+    parser.add_argument("--format", choices=["passim", "prepared"], default="passim")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each read benchmark")
+    parser.add_argument("--burst", type=int, default=100, help="Line updates per update burst")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="Previous results to compare with")
+    args = parser.parse_args()
+
+    app = temporary_app()
+    from app.db import db, Doc, Line, import_jsonl_stream, apply_line_updates
+
+    corpus = os.path.join(app.bench_directory, "corpus.jsonl")
+    write_corpus(corpus, args.documents, args.lines, args.line_length, args.format, args.seed)
+    results = {}
+    rnd = random.Random(args.seed)
+
+    def import_corpus():
+        with app.app_context(), open(corpus) as f:
+            for _ in import_jsonl_stream(f):
+                pass
+    timed(results, "import", import_corpus)
+    results["import"]["lines_per_second"] = round(args.documents * args.lines / results["import"]["total_s"])
+
+    # Validate half of the documents so that exports have content
+    with app.app_context():
+        doc_ids = db.session.scalars(db.select(Doc.id).order_by(Doc.id)).all()
+        for doc_id in doc_ids[::2]:
+            line_ids = db.session.scalars(db.select(Line.id).where(Line.doc_id == doc_id)).all()
+            apply_line_updates(doc_id, [{"id": line_id, "status": "Validated"} for line_id in line_ids])
+        db.session.commit()
+        lines = db.session.execute(db.select(Line.doc_id, Line.id)).all()
+
+    client = logged_in_client(app)
+    doc_id = doc_ids[len(doc_ids) // 2]
+
+    # Page 2 when the corpus has one, so that the list is timed with an offset
+    list_page = min(2, max(1, math.ceil(args.documents / DOCUMENT_LIST_PAGE_SIZE)))
+    timed(results, "document_list", lambda: get(client, f"/document?page={list_page}"), args.repeat)
+    timed(results, "document_list_search", lambda: get(client, "/document?search=0000"), args.repeat)
+    timed(results, "document_list_hide_done", lambda: get(client, "/document?hide=1"), args.repeat)
+    timed(results, "line_search", lambda: get(client, "/search?q=dñs&format=json"), args.repeat)
+    timed(results, "document_export", lambda: get(client, f"/document/{doc_id}"), args.repeat)
+    timed(results, "corpus_export", lambda: get(client, "/document?download=True"), args.repeat)
+    timed(results, "corpus_export_incomplete", lambda: get(client, "/document?download=True&incomplete=True"),
+          args.repeat)
+    timed(results, "lines_route", lambda: get(client, f"/document/{doc_id}/line"), args.repeat)
+    timed(results, "lines_page", lambda: get(client, f"/document/{doc_id}/lines"), args.repeat)
+    timed(results, "check_view", lambda: get(client, f"/document/{doc_id}/line?prettyPrint=True"), args.repeat)
+
+    def update_burst():
+        for _ in range(args.burst):
+            line_doc_id, line_id = rnd.choice(lines)
+            post(client, f"/document/{line_doc_id}/line/{line_id}",
+                 {"status": rnd.choice(["Validated", "Excluded"]), "normalized": "bench"})
+    timed(results, "line_update_burst", update_burst)
+
+    def batched_burst():
+        doc_lines = [line_id for line_doc_id, line_id in lines if line_doc_id == doc_id][:args.burst]
+        post(client, f"/document/{doc_id}/lines",
+             [{"id": line_id, "status": "Validated", "normalized": "bench"} for line_id in doc_lines])
+    timed(results, "batched_line_update", batched_burst, args.repeat)
+
+    report = {
+        "commit": current_commit(),
+        "date": datetime.datetime.now(datetime.UTC).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+""" Latency and SQL queries of line_route saves with and without the user loader cache.
+
+    python -m benchmarks.user_loader --requests 500
+
+The same logged-in client saves random lines with USER_CACHE_TTL set to 0 (a user query per request), then
+with the cache enabled.
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+from sqlalchemy import event
+
+from .common import temporary_app, logged_in_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500, help="Line saves per run")
+    parser.add_argument("--ttl", type=int, default=60, help="USER_CACHE_TTL of the cached run")
+    parser.add_argument("--source", default="source/n10.jsonl", help="JSONL file imported before the run")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    app = temporary_app()
+    from app.db import db, Line, import_jsonl_stream
+
+    with app.app_context():
+        with open(args.source) as f:
+            for _ in import_jsonl_stream(f):
+                pass
+        lines = db.session.execute(db.select(Line.doc_id, Line.id)).all()
+        engine = db.engine
+
+    client = logged_in_client(app)
+    queries = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        if queries:
+            queries[-1] += 1
+
+    rnd = random.Random(0)
+    report = {}
+    for name, ttl in (("uncached", 0), ("cached", args.ttl)):
+        app.config["USER_CACHE_TTL"] = ttl
+        latencies = []
+        queries.clear()
+        for _ in range(args.requests):
+            doc_id, line_id = rnd.choice(lines)
+            queries.append(0)
+            started = time.perf_counter()
+            response = client.post(f"/document/{doc_id}/line/{line_id}", json={"status": "Validated"})
+            latencies.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, f"line_route answered {response.status_code}"
+        latencies.sort()
+        report[name] = {
+            "requests": args.requests,
+            "mean_ms": round(statistics.mean(latencies), 3),
+            "p50_ms": round(latencies[len(latencies) // 2], 3),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)], 3),
+            "queries_per_request": round(statistics.mean(queries), 2),
+        }
+        print(f"{name:<10} {report[name]['mean_ms']:>8.3f} ms mean, {report[name]['p50_ms']:.3f} ms p50, "
+              f"{report[name]['p95_ms']:.3f} ms p95, {report[name]['queries_per_request']} queries per request")
+
+    saved = report["uncached"]["mean_ms"] - report["cached"]["mean_ms"]
+    print(f"Saved {saved:.3f} ms per request ({saved / report['uncached']['mean_ms'] * 100:.1f}%)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()